@@ -0,0 +1,323 @@
+"""
+Benchmarks for OrderedDequeSet and the data structure steps of the tweet pipeline.
+
+Every benchmark reports seconds per operation, except the alloc.* rows, which
+report bytes allocated per operation as measured by tracemalloc. Results are
+compared against the baselines stored in benchmarks.json, and the script exits
+non-zero if anything got slower than the allowed tolerance, so it can gate a change:
+
+    python benchmarks.py                 # run everything and compare to the baselines
+    python benchmarks.py --save          # run everything and store new baselines
+    python benchmarks.py -k discard      # only benchmarks whose name contains "discard"
+    python benchmarks.py --sizes 100,10000 --tolerance 3.0
+
+Baselines are machine specific; re-run with --save after moving to new hardware.
+A plain dict-based ordered set is benchmarked next to OrderedDequeSet as a reference
+point, and fan-out is also timed without the render cache. These reference_* rows are
+informational and never fail the run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+from collections import defaultdict
+from itertools import cycle, islice
+
+from dedup import TweetDedup
+from dequeset import DequeSetRegistry, OrderedDequeSet
+from dispatcher import Dispatcher, RenderCache, render_tweet
+from tweets import Tweet, TweetTimeline
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks.json")
+DEFAULT_SIZES = (100, 10_000, 1_000_000)
+# Operations timed per benchmark; large enough to amortize timer overhead
+OPS = 2_000
+# Timing runs per benchmark; the fastest one is reported
+REPEAT = 5
+# Times a slow benchmark is re-measured before it is reported as a regression
+RECHECKS = 2
+
+
+class DictOrderedSet:
+    """Reference ordered set built on a plain dict, which keeps insertion order"""
+
+    def __init__(self, items=(), maxlen=None):
+        self.map = dict.fromkeys(items)
+        self.maxlen = maxlen
+
+    def add(self, key):
+        if key not in self.map:
+            self.map[key] = None
+            if self.maxlen is not None and len(self.map) > self.maxlen:
+                del self.map[next(iter(self.map))]
+
+    def popleft(self):
+        key = next(iter(self.map))
+        del self.map[key]
+        return key
+
+    def discard(self, key):
+        self.map.pop(key, None)
+
+    def union(self, other):
+        result = DictOrderedSet(self.map, self.maxlen)
+        result.map.update(dict.fromkeys(other))
+        return result
+
+    def __getitem__(self, index):
+        return list(islice(self.map, index.start, index.stop))
+
+
+def per_op(stmt, number=OPS, repeat=REPEAT):
+    """Best-of-`repeat` seconds per call of `stmt`"""
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+
+def bench_set(cls, n):
+    """Time the core operations on a set of `n` items; returns {operation: seconds per op}"""
+    rnd = random.Random(n)
+    build = cls.from_unique if cls is OrderedDequeSet else cls
+    results = {}
+
+    oset = build(range(n), maxlen=n)
+    keys = iter(range(n, n + 10 * OPS))
+    results["add"] = per_op(lambda: oset.add(next(keys)))
+
+    if cls is OrderedDequeSet:
+        oset = build(range(n), maxlen=n)
+        lefts = iter(range(-1, -10 * OPS, -1))
+        results["addleft"] = per_op(lambda: oset.addleft(next(lefts)))
+
+    oset = build(range(n + REPEAT * OPS))
+    results["popleft"] = per_op(oset.popleft)
+
+    oset = build(range(n))
+    victims = iter(rnd.sample(range(n), min(n, REPEAT * OPS)))
+    results["discard"] = per_op(lambda: oset.discard(next(victims, -1)))
+
+    oset = build(range(n))
+    other = list(range(n - 50, n + 50))
+    results["union"] = per_op(lambda: oset.union(other), number=max(1, min(OPS, 10_000_000 // (n + 100))))
+
+    if cls is OrderedDequeSet:
+        oset = build(range(n))
+        probes = [rnd.randrange(n) for _ in range(OPS)]
+        probe = cycle(probes)
+        results["index"] = per_op(lambda: oset.index(next(probe)), number=10 * OPS)
+
+        oset = build(range(n))
+        oset.discard(n // 2)  # leave a tombstone in the way
+        results["getitem"] = per_op(lambda: oset[-1], number=10 * OPS)
+
+    oset = build(range(n))
+    start = n // 4
+    results["slice"] = per_op(lambda: oset[start : start + 100], number=max(1, min(OPS, 1_000_000 // (n + 1))))
+    return results
+
+
+def synthetic_tweets(start_id, count, handles, start_time=0.0):
+    return [
+        Tweet(start_time + i, handles[i % len(handles)], start_id + i, "synthetic tweet body " * 10)
+        for i in range(count)
+    ]
+
+
+def bench_fetch_step(handles=500, channels_per_handle=3):
+    """
+    The data structure part of Tweets.tweet_fetcher: pick the unseen tweets out
+    of a 20-tweet timeline, merge them into the recency buffer and group them by
+    subscribed account, with a couple of new tweets per tick.
+    """
+    names = ["handle%d" % i for i in range(handles)]
+    subsconfig = {name: list(range(channels_per_handle)) for name in names}
+    recency = TweetTimeline(synthetic_tweets(0, 200, names), maxlen=200)
+    seen = TweetDedup(maxlen=100_000)
+    seen.update(tweet.id for tweet in recency)
+    shared = DequeSetRegistry(maxlen=100)
+    timelines = [TweetTimeline(synthetic_tweets(2 * tick + 182, 20, names, 2 * tick + 182.0)) for tick in range(OPS * REPEAT)]
+    ticks = iter(timelines)
+
+    def step():
+        fresh = next(ticks)
+        to_send = defaultdict(list)
+        new = seen.filter(fresh)
+        recency.merge(new)
+        for tweet in new:
+            shared[tweet.screen_name].add(tweet)
+            if tweet.screen_name in subsconfig:
+                to_send[tweet.screen_name].append(tweet)
+        return to_send
+
+    return per_op(step)
+
+
+def bench_snapshot_step(handles=2_000, changed=20):
+    """
+    The read side of Texts.check_tweets: find the handles whose buffers changed
+    since the last tick and read their newest tweet.
+    """
+    names = ["handle%d" % i for i in range(handles)]
+    shared = DequeSetRegistry(maxlen=100)
+    for name in names:
+        shared[name].merge(synthetic_tweets(hash(name) % 10**9 * 1000, 100, [name]))
+    seen = shared.versions()
+    next_id = iter(range(10**12, 10**13))
+
+    def step():
+        for name in random.sample(names, changed):
+            shared[name].add(Tweet(0.0, name, next(next_id), "new"))
+        latest = []
+        for handle, version, tweets in shared.changed_since(seen):
+            seen[handle] = version
+            latest.append(tweets[-1])
+        return latest
+
+    return per_op(step, number=200)
+
+
+def bench_fanout(channels=1_000, cached=True):
+    """
+    The send side of Tweets.tweet_fetcher for one tweet followed by `channels`
+    channels: render it and queue it on the dispatcher for each of them. With
+    cached=False the tweet is rendered again for every channel.
+    """
+    names = ["handle%d" % i for i in range(50)]
+    tweets = iter(synthetic_tweets(0, 10 * OPS, names))
+
+    async def measure():
+        # No workers, so nothing is sent; only queueing is timed
+        dispatcher = Dispatcher(lambda channel_id: None, workers=0)
+        renders = RenderCache()
+
+        def step():
+            tweet = next(tweets)
+            if cached:
+                content, embed = renders.get(tweet)
+                for channel in range(channels):
+                    dispatcher.submit(channel, content=content, embed=embed)
+            else:
+                for channel in range(channels):
+                    content, embed = render_tweet(tweet)
+                    dispatcher.submit(channel, content=content, embed=embed)
+            renders.forget(tweet)
+
+        return per_op(step, number=50)
+
+    return asyncio.run(measure())
+
+
+def bench_tick_allocations(rebuild=False, ticks=OPS):
+    """
+    Bytes allocated per tick by merging two new tweets into a full 200-tweet
+    recency buffer, in place with merge(), or with rebuild=True by building a
+    new buffer with union() the way the fetcher used to.
+    """
+    names = ["handle%d" % i for i in range(50)]
+    recency = TweetTimeline(synthetic_tweets(0, 200, names), maxlen=200)
+    batches = [synthetic_tweets(200 + 2 * tick, 2, names, 200.0 + 2 * tick) for tick in range(ticks)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        allocated = 0
+        for batch in batches:
+            if rebuild:
+                recency = recency.union(batch)
+            else:
+                recency.merge(batch)
+            current, peak = tracemalloc.get_traced_memory()
+            # Everything allocated during the tick, whether or not it was kept
+            allocated += peak - before
+            before = current
+            tracemalloc.reset_peak()
+    finally:
+        tracemalloc.stop()
+    return allocated / ticks
+
+
+def run(sizes, pattern):
+    results = {}
+    for n in sizes:
+        for label, cls in (("OrderedDequeSet", OrderedDequeSet), ("reference_dict", DictOrderedSet)):
+            if pattern and not any(pattern in "%s.%s[%d]" % (label, op, n) for op in ("add", "addleft", "popleft", "discard", "union", "index", "getitem", "slice")):
+                continue
+            for op, seconds in bench_set(cls, n).items():
+                results["%s.%s[%d]" % (label, op, n)] = seconds
+    pipeline = (
+        ("pipeline.fetch_step", bench_fetch_step),
+        ("pipeline.snapshot_step", bench_snapshot_step),
+        ("pipeline.fanout_1k_channels", bench_fanout),
+        ("reference_uncached.fanout_1k_channels", lambda: bench_fanout(cached=False)),
+        ("alloc.tick_merge", bench_tick_allocations),
+        ("reference_alloc.tick_union", lambda: bench_tick_allocations(rebuild=True)),
+    )
+    for name, fn in pipeline:
+        if not pattern or pattern in name:
+            results[name] = fn()
+    if pattern:
+        results = {name: seconds for name, seconds in results.items() if pattern in name}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("-k", dest="pattern", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="comma separated set sizes")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="fail when slower than baseline by this factor")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run(sizes, args.pattern)
+
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baselines = json.load(f)
+
+    def regressed(name):
+        baseline = baselines.get(name)
+        return baseline and results[name] / baseline > args.tolerance and not name.startswith("reference_")
+
+    # Timings on a shared machine are noisy; a benchmark only counts as a regression
+    # if it is still slow after being measured again
+    for _ in range(RECHECKS):
+        for name in [name for name in results if regressed(name)]:
+            results[name] = min(results[name], run(sizes, name)[name])
+
+    regressions = []
+    print(f"{'benchmark':<40} {'us|B/op':>12} {'baseline':>12} {'ratio':>7}")
+    for name, value in results.items():
+        baseline = baselines.get(name)
+        ratio = value / baseline if baseline else None
+        # Timings are shown in microseconds, allocations in bytes
+        scale = 1 if "alloc." in name else 1e6
+        flag = ""
+        if regressed(name):
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<40} {value * scale:>12.3f} "
+            f"{baseline * scale if baseline else float('nan'):>12.3f} "
+            f"{ratio if ratio is not None else float('nan'):>7.2f}{flag}"
+        )
+
+    if args.save:
+        baselines.update(results)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} baselines to {BASELINE_PATH}")
+        return 0
+
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than {args.tolerance}x baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,7 @@ from collections import deque
 import os
 from pprint import pprint
 import asyncio
+import metrics
 
 
 def main():
@@ -45,6 +46,9 @@ def main():
 
     token = os.environ.get("DISCORD_BOT_TOKEN")
 
+    # Prometheus scrapes the pipeline metrics from here
+    metrics.start_server()
+
     bot.run(token)
 
 
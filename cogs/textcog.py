@@ -1,9 +1,13 @@
 from discord.ext import tasks, commands
 from texts import send_sms
-from collections import defaultdict
-from cogs.tweetcog import shared_tweets
-from dequeset import OrderedDequeSet
+from cogs.tweetcog import shared_tweets, MAX_TRACKED_HANDLES, MAX_BUFFERED_TWEETS
+from dequeset import DequeSetRegistry
 from tweets import create_api
+from users import user_lookup
+from store import shared_store
+from dedup import TweetDedup
+import metrics
+from latency import tracker
 import tweepy as tp
 import asyncio
 import os
@@ -11,20 +15,48 @@ import logging
 from pprint import pprint
 import ast
 import subprocess
-from copy import deepcopy
 from webhooks import app
 from threading import Thread
 import requests
 from encrypt import decrypt_msg
 import json
+import io
 
 class Texts(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.subsconfig = defaultdict(set)
+        self.store = shared_store()
+        self.subsconfig = self.store.subscriptions("texts")  # account <-> phone numbers
         self.api: tp.API = create_api()
-        # Needs to be pickled on shutdown:
-        self.msg_history = defaultdict(lambda: OrderedDequeSet(maxlen=100))
+        self.users = user_lookup()
+        # Saved on shutdown by cog_unload and restored here
+        self.msg_history = DequeSetRegistry(maxlen=100, max_keys=MAX_TRACKED_HANDLES)
+        # Ids of the tweets already texted out, rebuilt from msg_history on startup
+        self.texted = TweetDedup(maxlen=MAX_BUFFERED_TWEETS)
+        self.seen_versions = {}
+        self.load_history()
+        metrics.track_registry("msg_history", self.msg_history)
+
+    def load_history(self):
+        """Restore msg_history from the last snapshot, if there is one"""
+        try:
+            snapshot = self.store.load_blob("msg_history")
+            if snapshot is not None:
+                count = self.msg_history.load(io.BytesIO(snapshot))
+                self.texted.update(tweet.id for history in self.msg_history.values() for tweet, _ in history)
+                logging.info(f"Restored message history for {count} handles")
+        except Exception as e:
+            logging.warning(f"Could not restore message history: {e}")
+
+    def save_history(self):
+        """Snapshot msg_history into the store, replacing the previous snapshot"""
+        buf = io.BytesIO()
+        self.msg_history.dump(buf)
+        self.store.save_blob("msg_history", buf.getvalue())
+        self.store.flush()
+
+    def cog_unload(self):
+        self.save_history()
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -37,38 +69,38 @@ class Texts(commands.Cog):
 
     @tasks.loop(seconds=2)
     async def check_tweets(self):
-        numbers = set(number for handle in self.subsconfig for number in handle)
+        numbers = self.subsconfig.all_subscribers()
         try:
             resp = requests.get(f"http://3.92.223.40/get_changes")
             json_object = json.loads(decrypt_msg(resp, "priv_key.pm"))
             changes = [tuple(x) for x in json_object]
-            print("first")
             for num in numbers:
                 sub_changes = (c for c in changes if c[0] == num)
                 for s in [sub_changes]:
                     if s[-1] == "r":
-                        self.subsconfig[s[1]].remove(s[0])
+                        self.subsconfig.remove(s[1], s[0])
                         requests.post(f"http://3.92.223.40/clear_changes?number={num}&handle={s[1]}")
                     if s[-1] == "all":
-                        for h in self.subsconfig.values():
-                            h.remove(s[0])
-                            requests.post(f"http://3.92.223.40/clear_all_changes?number={num}")
+                        self.subsconfig.remove_subscriber(s[0])
+                        requests.post(f"http://3.92.223.40/clear_all_changes?number={num}")
                     if s[-1] == "a":
-                        self.subsconfig[s[1]].add(s[0])
+                        self.subsconfig.add(s[1], s[0])
                         requests.post(f"http://3.92.223.40/clear_changes?number={num}&handle={s[1]}")
-            print("second")
         except Exception as e:
             logging.info(e)
 
-        self.shared_tweets = deepcopy(shared_tweets)
-        for handle in self.shared_tweets: # Check each handle {handle: ODS[tweet1, tweet2, ...]}
-            if handle not in self.subsconfig:
+        # Only handles whose tweets changed since the last check come back, as read-only snapshots
+        for handle, version, tweets in shared_tweets.changed_since(self.seen_versions):
+            if handle not in self.subsconfig or not tweets:
                 continue
-            elif self.shared_tweets[handle][-1] not in [msg[0] for msg in self.msg_history[handle]]:
-                nums = tuple(self.subsconfig[handle]) # (num1, num2, ...) subscribed to this twitter handle
-                self.msg_history[handle].add((self.shared_tweets[handle][-1], nums))
+            self.seen_versions[handle] = version
+            if self.texted.add(tweets[-1].id):
+                nums = tuple(self.subsconfig.subscribers(handle)) # (num1, num2, ...) subscribed to this twitter handle
+                self.msg_history[handle].add((tweets[-1], nums))
                 for num in nums:
-                    await send_sms(num, self.shared_tweets[handle][-1][-1])
+                    with metrics.SMS_SEND_SECONDS.time():
+                        await send_sms(num, tweets[-1].text)
+                    tracker.sent_by_sms(tweets[-1].id)
 
     @check_tweets.before_loop
     async def _precheck(self):
@@ -87,12 +119,11 @@ class Texts(commands.Cog):
         else:
             try:
                 cleaned_name = args[1].strip().lower()
-                _ = self.api.get_user(screen_name=cleaned_name)
-                self.subsconfig[cleaned_name].add(args[0])
+                if (await self.users.alookup([cleaned_name]))[cleaned_name] is None:
+                    asyncio.create_task(ctx.send(f"Twitter user {args[1]} is not valid account"))
+                    return
+                self.subsconfig.add(cleaned_name, args[0])
                 asyncio.create_task(ctx.send(f"{args[0]} now following {args[1]}"))
-            except tp.NotFound as e:
-                asyncio.create_task(ctx.send(f"Twitter user {args[1]} is not valid account"))
-                logging.info(e)
             except Exception as e:
                 asyncio.create_task(ctx.send(f"Another error occurred please try again later"))
                 logging.warn(e)
@@ -107,12 +138,13 @@ class Texts(commands.Cog):
         else:
             try:
                 cleaned_name = args[1].strip().lower()
-                _ = self.api.get_user(screen_name=cleaned_name)
-                self.subsconfig[cleaned_name].remove(args[0])
+                if (await self.users.alookup([cleaned_name]))[cleaned_name] is None:
+                    asyncio.create_task(ctx.send(f"Twitter user {args[1]} is not valid account"))
+                    return
+                self.subsconfig.remove(cleaned_name, args[0])
+                if cleaned_name not in self.subsconfig:
+                    self.msg_history.pop(cleaned_name, None)
                 asyncio.create_task(ctx.send(f"{args[0]} unsubscribed from {args[1]}"))
-            except tp.NotFound as e:
-                asyncio.create_task(ctx.send(f"Twitter user {args[1]} is not valid account"))
-                logging.info(e)
             except Exception as e:
                 asyncio.create_task(ctx.send(f"Another error occurred please try again later"))
                 logging.warn(e)
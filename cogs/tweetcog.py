@@ -1,18 +1,53 @@
 from discord.ext import tasks, commands
-from discord import Embed, Colour
 from pprint import pprint
-from tweets import create_api, get_list_timeline
+from tweets import ListPool, TweetTimeline, add_list_members, create_api, reconcile_lists, remove_list_members
+from users import user_lookup
+from dispatcher import Dispatcher, RenderCache, render_tweet
+from dedup import TweetDedup
+from store import shared_store
+import metrics
+from latency import tracker
+from sources import ListSource, ReplaySource, StreamSource, SyntheticSource, TweetSource, write_jsonl
 from collections import deque, defaultdict
-from dequeset import OrderedDequeSet
+from dequeset import DequeSetRegistry, OrderedDequeSet, ThreadSafeOrderedDequeSet
 import tweepy as tp
 import asyncio
 import logging
-from datetime import datetime
 from dotenv import load_dotenv
 import os
 
 
-shared_tweets = defaultdict(lambda: OrderedDequeSet(maxlen=100))
+# Upper bounds on how many handles, and how many tweets across all of them, are buffered in memory
+MAX_TRACKED_HANDLES = 5000
+MAX_BUFFERED_TWEETS = 100_000
+
+TIMELINE_PAGE_SIZE = 200
+
+# Where tweets come from: "api" polls the lists below, "stream" reads a filtered stream from
+# STREAM_BASE_URL and polls the lists only to fill gaps, "replay" plays back TWEET_REPLAY_PATH
+# and "synthetic" generates SYNTHETIC_RATE tweets/sec across SYNTHETIC_HANDLES accounts
+TWEET_SOURCE = os.environ.get("TWEET_SOURCE", "api")
+STREAM_BASE_URL = os.environ.get("STREAM_BASE_URL", "https://api.twitter.com")
+# If set, every fetched tweet is also appended here as JSONL for later replay
+TWEET_RECORD_PATH = os.environ.get("TWEET_RECORD_PATH")
+
+# Tracked accounts are spread over this pool of lists, all owned by TWITTER_OWNER_ID
+TWITTER_LIST_IDS = [int(list_id) for list_id in os.environ.get("TWITTER_LIST_IDS", "1597755224684388353").split(",")]
+TWITTER_OWNER_ID = int(os.environ.get("TWITTER_OWNER_ID", "1094812631205101600"))
+# Most accounts moved between lists by one rebalance
+MAX_REBALANCE_MOVES = 100
+
+# Written by this cog and read by the SMS cog, both on the event loop; the
+# registry itself is not thread-safe. The buffers are, so one can be handed to
+# a worker thread, or awaited through an AsyncDequeSetView, as it is.
+shared_tweets = DequeSetRegistry(
+    maxlen=100,
+    factory=ThreadSafeOrderedDequeSet,
+    max_keys=MAX_TRACKED_HANDLES,
+    max_items=MAX_BUFFERED_TWEETS,
+)
+# Ids of the tweets already fetched, which is what decides whether a tweet is new
+seen_tweets = TweetDedup(maxlen=MAX_BUFFERED_TWEETS)
 
 
 class Tweets(commands.Cog):
@@ -22,89 +57,248 @@ class Tweets(commands.Cog):
         print(self._ROOTCHANNEL)
         self.bot = bot
         self.api: tp.API = create_api()
-        self.list_id = 1597755224684388353
-        self.owner_id = 1094812631205101600
-        self.recency_queue: OrderedDequeSet = OrderedDequeSet(maxlen=200)
-        self.tweets = defaultdict(lambda: OrderedDequeSet(maxlen=100))
-        self.tweet_ids = defaultdict(lambda: OrderedDequeSet(maxlen=100))
-        self.subsconfig = defaultdict(list)
+        self.users = user_lookup()
+        # Subscriptions, list members, cursors and delivered tweets survive restarts here
+        self.store = shared_store()
+        # Sends embeds from per-channel queues instead of one task per channel per tweet
+        self.dispatcher = Dispatcher(lambda channel_id: self.bot.get_channel(channel_id), on_sent=tracker.sent_to_discord)
+        self.lists = ListPool(TWITTER_LIST_IDS)
+        self.owner_id = TWITTER_OWNER_ID
+        # Held across every change to list membership, so the pool and the lists move together
+        self.list_lock = asyncio.Lock()
+        self._reconcile_task = None
+        # Rendered embeds are kept only as long as their tweet is in the recency buffer
+        self.renders = RenderCache()
+        self.recency_queue: TweetTimeline = TweetTimeline(maxlen=200, on_evict=self.renders.forget)
+        # Warm start, so tweets delivered before a restart are not sent again
+        self.recency_queue.merge(self.store.load_tweets())
+        seen_tweets.update(tweet.id for tweet in self.recency_queue)
+        self.tweets = DequeSetRegistry(maxlen=100, max_keys=MAX_TRACKED_HANDLES)
+        self.tweet_ids = DequeSetRegistry(maxlen=100, max_keys=MAX_TRACKED_HANDLES)
+        self.subsconfig = self.store.subscriptions("tweets")  # account <-> channel ids
         self.channels = defaultdict(list)
         self.global_list = []
-        self.count = 0
-        self.most_recent_update = datetime.now().timestamp()
+        metrics.on_sample(lambda: metrics.DISPATCH_QUEUE.set(self.dispatcher.pending()))
+        for name, registry in (("shared_tweets", shared_tweets), ("tweets", self.tweets), ("tweet_ids", self.tweet_ids)):
+            metrics.track_registry(name, registry)
+        self._loop_watcher = None
+        self.source = self.create_source()
+        # Append everything fetched to a JSONL file that ReplaySource can play back
+        self.recording = open(TWEET_RECORD_PATH, "a") if TWEET_RECORD_PATH else None
+
+    def create_source(self) -> TweetSource:
+        """Build the tweet source picked by TWEET_SOURCE: api, stream, replay or synthetic"""
+        if TWEET_SOURCE == "replay":
+            return ReplaySource(os.environ["TWEET_REPLAY_PATH"], speed=float(os.environ.get("TWEET_REPLAY_SPEED", 1.0)))
+        if TWEET_SOURCE == "synthetic":
+            return SyntheticSource(
+                rate=float(os.environ.get("SYNTHETIC_RATE", 100.0)),
+                handles=int(os.environ.get("SYNTHETIC_HANDLES", 1000)),
+            )
+        # Polling gets its own client that raises on 429 instead of sleeping, so the scheduler can wait it out
+        timeline_api = create_api(wait_on_rate_limit=False)
+        lists = ListSource(timeline_api, self.lists, self.owner_id, self.store, page_size=TIMELINE_PAGE_SIZE)
+        if TWEET_SOURCE == "stream":
+            return StreamSource(STREAM_BASE_URL, os.environ["BEARER_TOKEN"], backfill=lists)
+        return lists
+
+    async def update_tracking(self):
+        """Tell the source which accounts to follow, for sources like the stream that need it"""
+        try:
+            await self.source.track(self.global_list)
+        except Exception as e:
+            logging.warning(f"Could not update the followed accounts: {e!r}")
 
     @commands.Cog.listener()
     async def on_ready(self):
+        if self._loop_watcher is None:
+            self._loop_watcher = asyncio.create_task(metrics.watch_event_loop())
         if not self.tweet_fetcher.is_running():
-            members = self.api.get_list_members(list_id=self.list_id, owner_id=self.owner_id)
-            self.global_list = [member.screen_name for member in members]
+            # Offline sources do not talk to Twitter, so there are no list members to load
+            if self.source.uses_lists:
+                saved = self.store.load_list_members()
+                for list_id in self.lists.list_ids:
+                    self.lists.load(list_id, saved.get(list_id, ()))
+                # Check the saved members against the lists themselves without holding up the
+                # fetcher; with nothing saved yet, whatever is on the lists is adopted
+                self._reconcile_task = asyncio.create_task(self.reconcile_lists(adopt=not saved))
+            self.global_list = list(self.lists.placement)
+            await self.update_tracking()
             await self.tweet_fetcher.start()
 
-    def add_list_member(self, account):
-        self.api.add_list_member(list_id=self.list_id, owner_id=self.owner_id, screen_name=account)
+    async def add_to_lists(self, screen_names):
+        """
+        Place accounts on the lists and add them with one batched request per
+        list, off the event loop. Returns the accounts that could not be added.
+        """
+        async with self.list_lock:
+            by_list, failed = defaultdict(list), set()
+            for name in screen_names:
+                try:
+                    by_list[self.lists.place(name)].append(name)
+                except ValueError as e:
+                    # Every list in the pool is at the member limit
+                    logging.warning(f"Cannot add {name} to a list: {e}")
+                    failed.add(name)
+            for list_id, names in by_list.items():
+                try:
+                    await asyncio.to_thread(add_list_members, self.api, list_id, self.owner_id, names)
+                except tp.TweepyException as e:
+                    logging.warning(f"Could not add {', '.join(names)} to list {list_id}: {e}")
+                    for name in names:
+                        self.lists.remove(name)
+                    failed.update(names)
+                    continue
+                for name in names:
+                    self.store.set_list_member(name, list_id)
+            return failed
+
+    async def remove_from_lists(self, screen_names):
+        """Take accounts off their lists with one batched request per list, off the event loop"""
+        async with self.list_lock:
+            by_list = defaultdict(list)
+            for name in screen_names:
+                list_id = self.lists.remove(name)
+                if list_id is None:
+                    logging.warning(f"{name} is not on any of the lists")
+                    continue
+                self.store.set_list_member(name, None)
+                by_list[list_id].append(name)
+            for list_id, names in by_list.items():
+                try:
+                    await asyncio.to_thread(remove_list_members, self.api, list_id, self.owner_id, names)
+                except tp.TweepyException as e:
+                    # They stay on the list until the next reconcile takes them off
+                    logging.warning(f"Could not remove {', '.join(names)} from list {list_id}: {e}")
+
+    def forget_accounts(self, screen_names):
+        """
+        Stop tracking accounts: drop them from global_list, along with their
+        subscriptions, which the store saves, and their tweet buffers.
+        """
+        names = set(screen_names)
+        self.global_list = [name for name in self.global_list if name not in names]
+        for name in names:
+            self.subsconfig.remove_account(name)
+            shared_tweets.pop(name, None)
+            self.tweets.pop(name, None)
+            self.tweet_ids.pop(name, None)
+
+    def move_list_members(self, moves):
+        """Carry out ListPool.rebalance moves in batches, adding to the new list before leaving the old one"""
+        by_route = defaultdict(list)
+        for screen_name, from_list, to_list in moves:
+            by_route[from_list, to_list].append(screen_name)
+        for (from_list, to_list), names in by_route.items():
+            try:
+                add_list_members(self.api, to_list, self.owner_id, names)
+                remove_list_members(self.api, from_list, self.owner_id, names)
+            except tp.TweepyException as e:
+                logging.warning(f"Could not move {len(names)} accounts from list {from_list} to {to_list}: {e}")
+                continue
+            for name in names:
+                self.store.set_list_member(name, to_list)
+
+    async def reconcile_lists(self, adopt=False):
+        """
+        Make the Twitter lists hold exactly the accounts in global_list, reading
+        each list once and applying only the batched adds and removes needed.
+        With adopt, the lists' current members become global_list instead.
+        Returns the (adds, removes) made, by list id.
+        """
+        async with self.list_lock:
+            wanted = None if adopt else list(self.global_list)
+            try:
+                adds, removes = await asyncio.to_thread(reconcile_lists, self.api, self.lists, self.owner_id, wanted)
+            except tp.TweepyException as e:
+                logging.warning(f"Could not reconcile the Twitter lists: {e}")
+                return {}, {}
+            for names in removes.values():
+                for name in names:
+                    if name not in self.lists:
+                        self.store.set_list_member(name, None)
+            for name, list_id in self.lists.placement.items():
+                self.store.set_list_member(name, list_id)
+            if adopt:
+                self.global_list = list(self.lists.placement)
+            else:
+                self.global_list = [name for name in self.global_list if name in self.lists]
+        if adds or removes:
+            logging.info(f"Reconciled lists: added {sum(map(len, adds.values()))}, removed {sum(map(len, removes.values()))}")
+            await self.update_tracking()
+        return adds, removes
 
     @tasks.loop(seconds=1)
     async def tweet_fetcher(self):
-        fetched = False
-        while not fetched:
-            try:
-                fresh_tweets = get_list_timeline(self.list_id, self.owner_id, self.api)
-                fetched = True
-            except tp.TwitterServerError as ServerError:
-                logging.warning(f"Error caught: {ServerError}")
-                await asyncio.sleep(2)
+        try:
+            with metrics.FETCH_SECONDS.time():
+                fresh_tweets = await self.source.poll()
+        except Exception:
+            # An exception escaping the loop would stop it for good; the next tick retries instead
+            logging.exception("Polling the tweet source failed")
+            metrics.FETCH_FAILURES.inc()
+            return
+        metrics.FETCH_TWEETS.observe(len(fresh_tweets))
+        # The source decides when the next poll is due, e.g. from the rate limit
+        self.tweet_fetcher.change_interval(seconds=self.source.interval)
+        self.source.checkpoint()
+        if self.recording is not None and len(fresh_tweets) > 0:
+            write_jsonl(fresh_tweets, self.recording)
+            self.recording.flush()
 
         if len(self.recency_queue) > 0:
-            recent_tweet_timestamp = self.recency_queue[-1][0]
             to_send = defaultdict(list)
 
-            # Get only tweets newer than the recency queue
-            recent_tweets = OrderedDequeSet(
-                filter(
-                    lambda x: x[0] > recent_tweet_timestamp and x[0] > self.most_recent_update,
-                    fresh_tweets,
-                )
-            )
+            # A tweet is new if its id has not been seen, whatever its timestamp, so tweets
+            # posted in the same second and ones that show up late all get through
+            recent_tweets = seen_tweets.filter(fresh_tweets)
+            metrics.TWEETS_INGESTED.inc(len(recent_tweets))
+            metrics.DEDUP_HITS.inc(len(fresh_tweets) - len(recent_tweets))
+            tracker.detected(recent_tweets)
+            self.recency_queue.merge(recent_tweets)
+            self.store.record_tweets(recent_tweets)
 
             # Iterate through the neweest tweets and add them to the to_send pile
             for tweet in recent_tweets:
-                if tweet[1] in self.subsconfig:
-                    to_send[tweet[1]].append(tweet)
+                if tweet.screen_name in self.subsconfig:
+                    to_send[tweet.screen_name].append(tweet)
 
             if len(to_send) > 0:
                 for account, new_tweets in to_send.items():
-                    if self.subsconfig.get(account) is None:
+                    if account not in self.subsconfig:
                         continue
 
-                    channels = self.subsconfig.get(account)
-                    for channel in channels:
-                        [
-                            asyncio.create_task(
-                                self.bot.get_channel(channel).send(
-                                    content=f"https://twitter.com/{tweet[1]}/status/{tweet[2]}",
-                                    embed=Embed(
-                                        colour=Colour.from_rgb(52, 61, 65),
-                                        timestamp=datetime.fromtimestamp(tweet[0]),
-                                        title=f"@{tweet[1]}",
-                                        url=f"https://twitter.com/{tweet[1]}/status/{tweet[2]}",
-                                        description=tweet[3],
-                                        type="rich",
-                                    ),
-                                )
-                            )
-                            for tweet in new_tweets
-                        ]
-
-            self.recency_queue = self.recency_queue.union(recent_tweets)
-            [shared_tweets[tweet[1]].add(tweet) for tweet in recent_tweets]
-            self.count += 1
-            print(self.count)
-
-        else:  # first fetch tweet.created_at, tweet.author.screen_name.strip().lower(), tweet.id, tweet.full_text
-            self.recency_queue = OrderedDequeSet(fresh_tweets, maxlen=200)
-            [shared_tweets[tweet[1]].add(tweet) for tweet in self.recency_queue]
-            self.count += 1
-            print(self.count)
+                    channels = self.subsconfig.subscribers(account)
+                    for tweet in new_tweets:
+                        # A late tweet older than the whole recency buffer is not kept in it, so its render is not cached
+                        content, embed = self.renders.get(tweet) if tweet in self.recency_queue else render_tweet(tweet)
+                        for channel in channels:
+                            self.dispatcher.submit(channel, content=content, embed=embed, key=tweet.id)
+                        tracker.enqueued(tweet)
+
+            for tweet in recent_tweets:
+                shared_tweets[tweet.screen_name].add(tweet)
+            shared_tweets.trim()
+
+        else:  # first fetch
+            initial_tweets = self.recency_queue.merge(fresh_tweets)
+            seen_tweets.update(tweet.id for tweet in fresh_tweets)
+            self.store.record_tweets(initial_tweets)
+            for tweet in initial_tweets:
+                shared_tweets[tweet.screen_name].add(tweet)
+
+    async def cog_unload(self):
+        # Cancelling the loop also cancels a fetch still waiting for a worker
+        self.tweet_fetcher.cancel()
+        if self._reconcile_task is not None:
+            self._reconcile_task.cancel()
+        if self._loop_watcher is not None:
+            self._loop_watcher.cancel()
+        await self.dispatcher.close()
+        await self.source.close()
+        if self.recording is not None:
+            self.recording.close()
+        self.store.flush()
 
     @tweet_fetcher.before_loop
     async def _prefetch(self):
@@ -113,20 +307,14 @@ class Tweets(commands.Cog):
 
     async def add_user_to_list(self, screen_name):
         """Adds new user to twitter list member"""
-        self.api.add_list_member(list_id=self.list_id, screen_name=screen_name)
+        await self.add_to_lists([screen_name])
 
     def check_user_still_needed(self, screen_name):
-        return self.subsconfig.get(screen_name) is not None
+        return screen_name in self.subsconfig
 
     def command_cleaner(self, command: str):
         return command.lower()
 
-    def remove_list_user(self, screen_name: str):
-        try:
-            self.api.remove_list_member(list_id=self.list_id, owner_id=self.owner_id, screen_name=screen_name)
-        except tp.BadRequest:
-            print(f"ERROR: User {screen_name} not in the current list")
-
     @commands.command()
     async def showall(self, ctx: commands.Context):
         """Show all accounts the bot currently tracks"""
@@ -155,7 +343,7 @@ class Tweets(commands.Cog):
     @commands.command(name="followingnow")
     async def followingnow(self, ctx: commands.Context):
         """Display all the accounts the current channel is following"""
-        follows = [account for account, channels in self.subsconfig.items() if ctx.channel.id in channels]
+        follows = self.subsconfig.accounts(ctx.channel.id)
         lenfol = len(follows)
         if lenfol == 0:
             await ctx.reply("This channel is currently following: No one")
@@ -164,42 +352,51 @@ class Tweets(commands.Cog):
 
     @commands.command()
     async def follow(self, ctx: commands.Context, *args):
-        """Follow a new user in this channel"""
+        """Follow one or more users in this channel"""
         if not args:
             await ctx.reply("Please provide an account with the command e.g ?follow firstsquawk or ?follow !all")
 
-        elif len(args) > 1:
-            await ctx.reply("?follow can only handle one account at a time.")
-
         elif args[0] == "!all":
             if not self.global_list:
                 await ctx.reply("No one in global list, please specify an account")
-                self.most_recent_update = datetime.now().timestamp()
             else:
+                # Every account here is already on a list, so no list requests are needed
                 for account in self.global_list:
-                    self.subsconfig[account].append(ctx.channel.id)
-                    self.most_recent_update = datetime.now().timestamp()
-                ctx.reply(f"Following all stored accounts")
+                    self.subsconfig.add(account, ctx.channel.id)
+                await ctx.reply(f"Following all stored accounts")
 
         else:
             try:
-                cleaned_name = args[0].strip().lower()
-                _ = self.api.get_user(screen_name=cleaned_name)
-                if ctx.channel.id not in self.subsconfig[cleaned_name]:
-                    self.subsconfig[cleaned_name].append(ctx.channel.id)
-                    if cleaned_name not in self.global_list:
-                        self.global_list.append(cleaned_name)
-                        self.add_list_member(cleaned_name)
-                        await ctx.reply(f"Now following {args[0]}")
-                        self.most_recent_update = datetime.now().timestamp()
-                else:
-                    await ctx.reply(f"Twitter user {args[0]} is already followed on this channel.")
-            except tp.NotFound as e:
-                await ctx.reply(f"Twitter user {args[0]} is not valid account")
-                logging.info(e)
+                # One cached, batched lookup validates every account in the command
+                users = await self.users.alookup(args)
             except Exception as e:
                 print(e)
                 await ctx.reply(f"Another error occurred please try again later")
+                return
+
+            new_accounts = {}
+            for account in args:
+                cleaned_name = account.strip().lower()
+                if users[cleaned_name] is None:
+                    await ctx.reply(f"Twitter user {account} is not valid account")
+                elif not self.subsconfig.add(cleaned_name, ctx.channel.id):
+                    await ctx.reply(f"Twitter user {account} is already followed on this channel.")
+                elif cleaned_name in self.global_list:
+                    await ctx.reply(f"Now following {account}")
+                else:
+                    new_accounts[cleaned_name] = account
+
+            if new_accounts:
+                # Every new account in the command goes onto the lists in one request per list
+                failed = await self.add_to_lists(list(new_accounts))
+                for cleaned_name, account in new_accounts.items():
+                    if cleaned_name in failed:
+                        self.subsconfig.remove(cleaned_name, ctx.channel.id)
+                        await ctx.reply(f"Cannot follow {account} right now, please try again later")
+                    else:
+                        self.global_list.append(cleaned_name)
+                        await ctx.reply(f"Now following {account}")
+                await self.update_tracking()
 
     @commands.command()
     async def unfollow(self, ctx: commands.Context, *args):
@@ -207,12 +404,9 @@ class Tweets(commands.Cog):
         rem = []
 
         for name in args:
-            try:
-                name = name.lower().strip()
-                self.subsconfig[name].remove(ctx.channel.id)
+            name = name.lower().strip()
+            if self.subsconfig.remove(name, ctx.channel.id):
                 rem.append(name)
-            except (ValueError, KeyError):
-                pass
         if not rem:
             asyncio.create_task(ctx.reply(f"Removed no one from your channel's follows list"))
         else:
@@ -220,12 +414,18 @@ class Tweets(commands.Cog):
                 asyncio.create_task(ctx.reply(f"Removed {rem[0]} from your channel's follows list"))
             else:
                 asyncio.create_task(ctx.reply(f"Removed {', '.join(rem)} from your channel's follows list"))
-            for name in rem:
-                needed = self.check_user_still_needed(name)
-                if not needed:
-                    self.global_list.remove(name)
-                    del self.subsconfig[name]
-                    self.remove_list_user(name)
+            unneeded = [name for name in rem if not self.check_user_still_needed(name)]
+            # A reconcile may already have dropped an account it could not place from global_list
+            self.forget_accounts(unneeded)
+            await self.remove_from_lists([name for name in unneeded if name in self.lists])
+
+            # An emptied list still costs a request every poll, so spread the others back over it
+            async with self.list_lock:
+                if any(not members for members in self.lists.members.values()):
+                    moves = self.lists.rebalance(max_moves=MAX_REBALANCE_MOVES)
+                    if moves:
+                        await asyncio.to_thread(self.move_list_members, moves)
+            await self.update_tracking()
 
     @commands.command()
     async def start(self, ctx: commands.Context):
@@ -250,28 +450,96 @@ class Tweets(commands.Cog):
 
         await ctx.reply("Tweet fetcher not running")
 
+    @commands.command(hidden=True)
+    async def rootmem(self, ctx: commands.Context):
+        """Allows admin channel to see how much tweet data is held in memory"""
+        if ctx.channel.id != self._ROOTCHANNEL:
+            return
+        registries = {"shared_tweets": shared_tweets, "tweets": self.tweets, "tweet_ids": self.tweet_ids}
+        texts = self.bot.get_cog("Texts")
+        if texts is not None:
+            registries["msg_history"] = texts.msg_history
+
+        lines = []
+        for name, registry in registries.items():
+            stats = registry.stats()
+            lines.append(f"{name}: {stats['keys']} handles, {stats['items']} items, ~{stats['bytes'] // 1024} KiB")
+        lines.append(f"recency_queue: {len(self.recency_queue)} tweets, {len(self.renders)} rendered")
+        seen = seen_tweets.stats()
+        lines.append(f"seen tweets: {seen['ids']} ids, {seen['duplicates']} duplicates dropped")
+        lines.append(f"subscriptions: {self.subsconfig.subscription_count} across {len(self.subsconfig)} accounts")
+        store = self.store.stats()
+        lines.append(f"store: {store['pending']} changes pending, {store['written']} written in {store['flushes']} flushes")
+        users = self.users.stats()
+        lines.append(f"user cache: {users['cached']} handles, {users['hits']} hits, {users['misses']} misses, {users['requests']} requests")
+        await ctx.reply("\n".join(lines))
+
+    @commands.command(hidden=True)
+    async def rootpoll(self, ctx: commands.Context):
+        """Allows admin channel to see the poll interval and how much of the rate limit is left"""
+        if ctx.channel.id != self._ROOTCHANNEL:
+            return
+        stats = self.source.stats()
+        if not isinstance(self.source, ListSource):
+            lines = [f"{key}: {value}" for key, value in stats.items()]
+        else:
+            lines = [
+                f"interval: {stats['interval']:.1f}s (budget {stats['budget_interval']:.1f}s, activity {stats['activity_interval']:.1f}s)",
+                f"quota: {stats['remaining']}/{stats['limit']} left, resets in {stats['reset_in'] or 0:.0f}s",
+                f"failures: {stats['failures']}, circuit {'open' if stats['circuit_open'] else 'closed'}",
+            ]
+        sends = self.dispatcher.stats()
+        lines.append(
+            f"dispatch: {sends['pending']} queued for {sends['channels']} channels, "
+            f"{sends['sent']} embeds in {sends['messages']} messages, {sends['dropped']} dropped"
+        )
+        await ctx.reply("\n".join(lines))
+
+    @commands.command(hidden=True)
+    async def rootstats(self, ctx: commands.Context):
+        """Allows admin channel to see the pipeline metrics that /metrics exports"""
+        if ctx.channel.id != self._ROOTCHANNEL:
+            return
+        await ctx.reply("\n".join(metrics.summary()))
+
+    @commands.command(hidden=True)
+    async def rootlatency(self, ctx: commands.Context, account: str = None):
+        """Allows admin channel to see how long tweets take to be delivered, overall or for one account"""
+        if ctx.channel.id != self._ROOTCHANNEL:
+            return
+        await ctx.reply("\n".join(tracker.summary(account.strip().lower() if account else None)))
+
     @commands.command(hidden=True)
     async def rootremove(self, ctx: commands.Context, *args):
         """Allows admin channel to remove a user from the twitter list"""
         if ctx.channel.id != self._ROOTCHANNEL:
             return
-        if len(args) > 1:
-            asyncio.create_task(ctx.reply(f"Cannot pass more than one user to remove"))
+        if len(args) != 1:
+            asyncio.create_task(ctx.reply(f"Please pass exactly one user to remove"))
             return
-        self.remove_list_user(args[0])
-        if self.subsconfig.get(args[0]):
-            del self.subsconfig[args[0]]
+        name = args[0].strip().lower()
+        # Dropped from global_list too, or the next reconcile would put it straight back on a list
+        self.forget_accounts([name])
+        await self.remove_from_lists([name])
+        await self.update_tracking()
 
     @commands.command(hidden=True)
     async def rootremoveall(self, ctx: commands.Context):
         if ctx.channel.id != self._ROOTCHANNEL:
             return
 
-        all_users = self.api.get_list_members(list_id=self.list_id, owner_id=self.owner_id)
-        for user in all_users:
-            screen_name = user.screen_name
-            self.remove_list_user(screen_name=screen_name)
-        asyncio.create_task(ctx.reply("Removed all users from twitter list"))
+        self.forget_accounts(set(self.global_list) | set(self.subsconfig))
+        await self.remove_from_lists(list(self.lists.placement))
+        await self.update_tracking()
+        asyncio.create_task(ctx.reply("Removed all users from twitter lists"))
+
+    @commands.command(hidden=True)
+    async def rootreconcile(self, ctx: commands.Context):
+        """Allows admin channel to make the Twitter lists match the tracked accounts"""
+        if ctx.channel.id != self._ROOTCHANNEL:
+            return
+        adds, removes = await self.reconcile_lists()
+        await ctx.reply(f"Added {sum(map(len, adds.values()))} and removed {sum(map(len, removes.values()))} list members")
 
 
 async def setup(bot: commands.Bot):
@@ -0,0 +1,156 @@
+"""
+Which tweets have already been seen, by tweet id.
+
+Deciding what is new by comparing timestamps drops tweets posted in the same
+second as the last one seen, and tweets that arrive out of order. TweetDedup
+remembers the ids themselves instead, within a window bounded by count and
+optionally by age, and answers in O(1). For long windows it can trade the
+exact set for a counting Bloom filter, which needs a few bytes per id instead
+of a Python int in a set.
+"""
+import math
+import time
+from array import array
+from typing import Iterable, List, Optional
+
+from tweets import Tweet
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix(x: int) -> int:
+    """splitmix64's finalizer; spreads sequential tweet ids over 64 bits"""
+    z = (x + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+class CountingBloomFilter:
+    """
+    A Bloom filter over ints with 8-bit counters, so items can be removed again.
+    Sized for `capacity` items at a false positive rate of `error_rate`.
+    Counters that reach 255 stay there, which can only add false positives.
+
+    Example:
+        >>> bloom = CountingBloomFilter(capacity=100, error_rate=0.01)
+        >>> bloom.add(42)
+        >>> 42 in bloom, 43 in bloom
+        (True, False)
+        >>> bloom.remove(42)
+        >>> 42 in bloom
+        False
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.size = max(1, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.counters = bytearray(self.size)
+
+    def _slots(self, item: int) -> Iterable[int]:
+        # Double hashing: k slots from two independent hashes
+        h1 = _mix(item)
+        h2 = _mix(item ^ 0x5851F42D4C957F2D) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: int) -> None:
+        counters = self.counters
+        for slot in self._slots(item):
+            if counters[slot] < 255:
+                counters[slot] += 1
+
+    def remove(self, item: int) -> None:
+        """Remove an item that was added; removing anything else corrupts the filter"""
+        counters = self.counters
+        for slot in self._slots(item):
+            if 0 < counters[slot] < 255:
+                counters[slot] -= 1
+
+    def __contains__(self, item: int) -> bool:
+        counters = self.counters
+        return all(counters[slot] for slot in self._slots(item))
+
+
+class TweetDedup:
+    """
+    The ids of the last `maxlen` tweets seen, forgetting any seen more than
+    `max_age` seconds ago. Ids are kept in a fixed-size ring of int64s.
+
+    With `bloom_error` set, membership is answered by a CountingBloomFilter
+    sized for `maxlen` ids instead of a set; a new tweet is then mistaken for
+    a seen one at about that rate.
+
+    Example:
+        >>> seen = TweetDedup(maxlen=3)
+        >>> [tweet.id for tweet in seen.filter([Tweet(100.0, "a", 12, ""), Tweet(100.0, "a", 11, "")])]
+        [12, 11]
+        >>> seen.add(12), seen.add(13)
+        (False, True)
+    """
+
+    def __init__(self, maxlen: int = 100_000, max_age: Optional[float] = None, bloom_error: Optional[float] = None):
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self._ids = array("q", bytes(8 * maxlen))
+        self._seen_at = array("d", bytes(8 * maxlen)) if max_age is not None else None
+        self._start = 0
+        self._count = 0
+        self._set = set() if bloom_error is None else None
+        self._bloom = CountingBloomFilter(maxlen, bloom_error) if bloom_error is not None else None
+        self.duplicates = 0
+
+    def _forget_oldest(self) -> None:
+        tweet_id = self._ids[self._start]
+        if self._set is not None:
+            self._set.discard(tweet_id)
+        else:
+            self._bloom.remove(tweet_id)
+        self._start = (self._start + 1) % self.maxlen
+        self._count -= 1
+
+    def _expire(self, now: float) -> None:
+        if self._seen_at is None:
+            return
+        cutoff = now - self.max_age
+        while self._count and self._seen_at[self._start] < cutoff:
+            self._forget_oldest()
+
+    def __contains__(self, tweet_id: int) -> bool:
+        self._expire(time.monotonic())
+        return tweet_id in (self._set if self._set is not None else self._bloom)
+
+    def add(self, tweet_id: int, now: float = None) -> bool:
+        """Mark `tweet_id` seen; returns False if it already was"""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        if tweet_id in (self._set if self._set is not None else self._bloom):
+            self.duplicates += 1
+            return False
+        if self._count == self.maxlen:
+            self._forget_oldest()
+        end = (self._start + self._count) % self.maxlen
+        self._ids[end] = tweet_id
+        if self._seen_at is not None:
+            self._seen_at[end] = now
+        if self._set is not None:
+            self._set.add(tweet_id)
+        else:
+            self._bloom.add(tweet_id)
+        self._count += 1
+        return True
+
+    def update(self, tweet_ids: Iterable[int]) -> None:
+        now = time.monotonic()
+        for tweet_id in tweet_ids:
+            self.add(tweet_id, now)
+
+    def filter(self, tweets: Iterable[Tweet]) -> List[Tweet]:
+        """Return the tweets not seen before, in order, and mark them seen"""
+        now = time.monotonic()
+        return [tweet for tweet in tweets if self.add(tweet.id, now)]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def stats(self) -> dict:
+        return {"ids": self._count, "duplicates": self.duplicates, "bloom": self._bloom is not None}
@@ -6,32 +6,71 @@ Interally, it maintains a deque allowing for addleft, popleft, and max length.
 By default, items are popped off the left when adding to the right, and from the right
 when adding to the left.
 
+Positions in the index map are stored relative to a moving base offset, so pushing
+or popping on either end is O(1) and never requires re-enumerating the deque.
+Removing an item from the middle leaves a tombstone in its slot, and tombstones are
+compacted away in batches once they make up too much of the deque.
+
 Based on a recipe originally posted to ActiveState Recipes by Raymond Hettiger,
 and released under the MIT license. 
 
 Tweaked by imbesci and rereleased under the MIT license.
 """
+import asyncio
+import gc
 import itertools as it
+import pickle
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from operator import itemgetter
 from typing import (
     Any,
+    BinaryIO,
+    Callable,
     Dict,
     Iterable,
+    Hashable,
     Iterator,
     List,
+    MutableMapping,
     MutableSet,
+    Optional,
     AbstractSet,
     Sequence,
     Set,
+    Tuple,
     TypeVar,
     Union,
     overload,
 )
 
-from collections import deque
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
 
 SLICE_ALL = slice(None)
 __version__ = "4.1.0"
 
+# Versions are drawn from one global counter, so a set that is dropped and
+# recreated under the same key can never be mistaken for an unchanged one.
+_VERSIONS = it.count(1)
+
+# Placeholder left in the deque by a removal from the middle, until compaction
+_TOMBSTONE = object()
+
+# Binary snapshot framing: magic, format version, maxlen (-1 for unbounded), item count
+_SET_HEADER = struct.Struct("<4sBiI")
+_SET_MAGIC = b"ODS1"
+# Registry framing: magic, format version, number of sets, then per set a
+# length-prefixed pickled key followed by a length-prefixed set snapshot
+_REGISTRY_HEADER = struct.Struct("<4sBI")
+_REGISTRY_MAGIC = b"ODSR"
+_RECORD_LENGTH = struct.Struct("<I")
+SNAPSHOT_VERSION = 1
+
 
 T = TypeVar("T")
 
@@ -41,6 +80,21 @@ SetLike = Union[AbstractSet[T], Sequence[T]]
 OrderedDequeSetInitializer = Union[AbstractSet[T], Sequence[T], Iterable[T]]
 
 
+@contextmanager
+def _gc_paused():
+    """
+    Pause the cyclic garbage collector. Bulk-loading hundreds of thousands of
+    objects otherwise triggers repeated full collections that find nothing.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
 def _is_atomic(obj: Any) -> bool:
     """
     Returns True for objects which are iterable but should not be iterated in
@@ -64,17 +118,34 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
     """
     An OrderedDequeSet is a custom MutableSet that remembers its order so that
     every entry has an index that can be looked up. Additionally, it provides a
-    maxlen parameter to specify the maximum size of the structure.
+    maxlen parameter to specify the maximum size of the structure, and an
+    optional on_evict callback that is handed every item maxlen pushes out.
 
     Example:
         >>> OrderedDequeSet([1, 1, 2, 3, 2])
         OrderedDequeSet([1, 2, 3])
     """
 
-    def __init__(self, initial: OrderedDequeSetInitializer[T] = None, maxlen=None):
+    # Compact once tombstones make up more than this fraction of the deque
+    tombstone_ratio = 0.5
+
+    def __init__(
+        self,
+        initial: OrderedDequeSetInitializer[T] = None,
+        maxlen=None,
+        on_evict: Optional[Callable[[T], Any]] = None,
+    ):
         self.items: deque[T] = deque([], maxlen=maxlen)
         self.map: Dict[T, int] = {}
         self._maxlen = maxlen
+        self.on_evict = on_evict
+        # Absolute position of self.items[0]; self.map stores absolute positions
+        self._base = 0
+        # Sorted absolute positions of tombstones; the deque never starts or ends with one
+        self._holes: List[int] = []
+        self._version = 0
+        self._snapshot: Tuple[T, ...] = ()
+        self._snapshot_version = 0
         if initial is not None:
             # In terms of duck-typing, the default __ior__ is compatible with
             # the types we use, but it doesn't expect all the types we
@@ -91,7 +162,7 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
             >>> len(OrderedDequeSet([1, 2]))
             2
         """
-        return len(self.items)
+        return len(self.items) - len(self._holes)
 
     @property
     def maxlen(self):
@@ -102,7 +173,12 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         if not isinstance(value, int):
             raise TypeError("'maxlen' must be an integer")
 
+        # Compact under the old limit; compacting under the new one would let
+        # the deque drop items behind the index's back, without on_evict
+        self.compact()
         self._maxlen = value
+        while len(self.items) > value:
+            self._evicted(self._evict_left())
         self.items = deque(self.items, maxlen=value)
 
     @overload
@@ -132,20 +208,20 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         the number of elements asked for.
 
         Example:
-            >>> oset = OrderedDequeSet([1, 2, 3])
+            >>> oset = OrderedDequeSet([1, 2, 3, 4])
             >>> oset[1]
             2
+            >>> oset[1:3]
+            OrderedDequeSet([2, 3])
         """
         if isinstance(index, slice) and index == SLICE_ALL:
             return self.copy()
         elif isinstance(index, Iterable):
-            return [self.items[i] for i in index]
-        elif isinstance(index, slice) or hasattr(index, "__index__"):
-            result = self.items[index]
-            if isinstance(result, list):
-                return self.__class__(result)
-            else:
-                return result
+            return [self.items[self._physical(i)] for i in index]
+        elif isinstance(index, slice):
+            return self.__class__(list(self)[index])
+        elif hasattr(index, "__index__"):
+            return self.items[self._physical(index.__index__())]
         else:
             raise TypeError("Don't know how to index an OrderedDequeSet by %r" % index)
 
@@ -163,26 +239,69 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         """
         return self.__class__(self, maxlen=self.maxlen)
 
+    @classmethod
+    def from_unique(cls, items: Iterable[T], maxlen=None, **kwargs) -> "OrderedDequeSet[T]":
+        """
+        Bulk-load a set from items that are already unique (and, for a
+        TimeOrderedDequeSet, already in timestamp order), building the index in
+        one pass instead of adding them one at a time. Duplicates are not
+        checked for.
+
+        Example:
+            >>> OrderedDequeSet.from_unique([1, 2, 3], maxlen=2)
+            OrderedDequeSet([2, 3])
+        """
+        oset = cls(maxlen=maxlen, **kwargs)
+        oset._update_items(items)
+        return oset
+
     # Define the gritty details of how an OrderedDequeSet is serialized as a pickle.
     # We leave off type annotations, because the only code that should interact
     # with these is a generalized tool such as pickle.
     def __getstate__(self):
-        if len(self) == 0:
-            # In pickle, the state can't be an empty list.
-            # We need to return a truthy value, or else __setstate__ won't be run.
-            #
-            # This could have been done more gracefully by always putting the state
-            # in a tuple, but this way is backwards- and forwards- compatible with
-            # previous versions of OrderedDequeSet.
-            return (None,)
-        else:
-            return list(self)
+        return {"items": list(self), "maxlen": self.maxlen}
 
     def __setstate__(self, state):
-        if state == (None,):
+        if isinstance(state, dict):
+            self.__init__(maxlen=state["maxlen"])
+            self._update_items(state["items"])
+        elif state == (None,):
+            # Pickles from older versions stored only the items, using (None,)
+            # for an empty set.
             self.__init__([])
         else:
-            self.__init__(state)
+            self.__init__()
+            self._update_items(state)
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the set, including its maxlen, into a compact versioned binary
+        snapshot that from_bytes() can restore without re-adding every item.
+
+        Example:
+            >>> oset = OrderedDequeSet([1, 2, 3], maxlen=5)
+            >>> restored = OrderedDequeSet.from_bytes(oset.to_bytes())
+            >>> restored, restored.maxlen
+            (OrderedDequeSet([1, 2, 3]), 5)
+        """
+        maxlen = -1 if self.maxlen is None else self.maxlen
+        header = _SET_HEADER.pack(_SET_MAGIC, SNAPSHOT_VERSION, maxlen, len(self))
+        return header + pickle.dumps(list(self), pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, **kwargs) -> "OrderedDequeSet[T]":
+        """
+        Restore a set serialized with to_bytes().
+
+        Raises ValueError if `data` is not a snapshot this version understands.
+        """
+        magic, version, maxlen, count = _SET_HEADER.unpack_from(data)
+        if magic != _SET_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported OrderedDequeSet snapshot (magic %r, version %d)" % (magic, version))
+        items = pickle.loads(data[_SET_HEADER.size :])
+        if len(items) != count:
+            raise ValueError("Corrupt OrderedDequeSet snapshot: expected %d items, got %d" % (count, len(items)))
+        return cls.from_unique(items, maxlen=None if maxlen < 0 else maxlen, **kwargs)
 
     def __contains__(self, key: Any) -> bool:
         """
@@ -196,48 +315,192 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         """
         return key in self.map
 
-    def refresh_index(fn):
-        """Decorator to refresh the index values to ensure correctness in self.map"""
+    @property
+    def version(self) -> int:
+        """A number that changes every time the contents of the set change"""
+        return self._version
+
+    def _touch(self) -> None:
+        self._version = next(_VERSIONS)
+
+    def snapshot(self) -> Tuple[T, ...]:
+        """
+        Return an immutable view of the current items.
 
-        def _helper(self, *args, **kwargs):
-            res = fn(self, *args, **kwargs)
-            for i, key in enumerate(self.items):
-                self.map[key] = i
-            return res
+        The view is built once per version and shared by every caller until
+        the set is next modified, so repeated reads of an unchanged set cost
+        nothing. Items themselves are never copied.
+
+        Example:
+            >>> oset = OrderedDequeSet([1, 2])
+            >>> view = oset.snapshot()
+            >>> view is oset.snapshot()
+            True
+            >>> oset.add(3)
+            2
+            >>> view, oset.snapshot()
+            ((1, 2), (1, 2, 3))
+        """
+        if self._snapshot_version != self._version:
+            self._snapshot = tuple(self)
+            self._snapshot_version = self._version
+        return self._snapshot
+
+    def _physical(self, i: int) -> int:
+        """Translate index `i` (possibly negative) into a position in self.items"""
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("OrderedDequeSet index out of range")
+        if not self._holes or i == 0:
+            return i
+        if i == n - 1:
+            return len(self.items) - 1
+        # Every tombstone at or before the candidate position pushes it one slot right
+        pos = self._base + i
+        for hole in self._holes:
+            if hole > pos:
+                break
+            pos += 1
+        return pos - self._base
+
+    def _logical(self, pos: int) -> int:
+        """Translate an absolute position from self.map into an index"""
+        if not self._holes:
+            return pos - self._base
+        return pos - self._base - bisect_left(self._holes, pos)
+
+    def _full(self) -> bool:
+        """Whether there is no free slot left, compacting tombstones first if that makes room"""
+        if self._maxlen is None or len(self.items) < self._maxlen:
+            return False
+        self.compact()
+        return len(self.items) >= self._maxlen
+
+    # The slot primitives are the only places that shrink self.items at either
+    # end, so subclasses keeping parallel columns only need to override these.
+    def _popleft_slot(self) -> Any:
+        return self.items.popleft()
+
+    def _pop_slot(self) -> Any:
+        return self.items.pop()
+
+    def __sizeof__(self) -> int:
+        """Size of the containers making up the set, not counting the items themselves"""
+        return (
+            object.__sizeof__(self)
+            + sys.getsizeof(self.items)
+            + sys.getsizeof(self.map)
+            + sys.getsizeof(self._holes)
+            + sys.getsizeof(self._snapshot)
+        )
+
+    def _evicted(self, elem: T) -> None:
+        """Report an item that maxlen pushed out of the set"""
+        if self.on_evict is not None:
+            self.on_evict(elem)
+
+    def _evict_left(self) -> T:
+        """Drop the leftmost item to make room, keeping self.map in sync"""
+        self._touch()
+        elem = self._popleft_slot()
+        del self.map[elem]
+        self._base += 1
+        while self._holes and self._holes[0] == self._base:
+            self._popleft_slot()
+            del self._holes[0]
+            self._base += 1
+        return elem
 
-        return _helper
+    def _evict_right(self) -> T:
+        """Drop the rightmost item to make room, keeping self.map in sync"""
+        self._touch()
+        elem = self._pop_slot()
+        del self.map[elem]
+        while self._holes and self._holes[-1] == self._base + len(self.items) - 1:
+            self._pop_slot()
+            self._holes.pop()
+        return elem
+
+    def _delete_slot(self, p: int) -> T:
+        """
+        Remove the item at position `p` of self.items. Items in the middle are
+        replaced by a tombstone, so no other position has to be rewritten.
+        """
+        if p == 0:
+            return self._evict_left()
+        if p == len(self.items) - 1:
+            return self._evict_right()
+        self._touch()
+        elem = self.items[p]
+        self.items[p] = _TOMBSTONE
+        del self.map[elem]
+        insort(self._holes, self._base + p)
+        if len(self._holes) > self.tombstone_ratio * len(self.items):
+            self.compact()
+        return elem
+
+    def compact(self) -> None:
+        """
+        Drop the tombstones left behind by removals and renumber the index. This
+        runs automatically once tombstones make up more than `tombstone_ratio`
+        of the deque, so it rarely needs to be called directly.
+
+        Example:
+            >>> oset = OrderedDequeSet([1, 2, 3, 4, 5])
+            >>> oset.discard(3)
+            >>> oset.compact()
+            >>> oset.index(4), len(oset.items)
+            (2, 4)
+        """
+        if not self._holes:
+            return
+        self.items = deque((item for item in self.items if item is not _TOMBSTONE), maxlen=self._maxlen)
+        self._holes = []
+        for i, item in enumerate(self.items, self._base):
+            self.map[item] = i
 
     # Technically type-incompatible with MutableSet, because we return an
     # int instead of nothing. This is also one of the things that makes
     # OrderedDequeSet convenient to use.
 
-    @refresh_index
     def add(self, key: T) -> int:
         """
         Add `key` as an item to this OrderedDequeSet, then return its index.
 
         If `key` is already in the OrderedDequeSet, return the index it already
-        had.
+        had. If the set is full, the leftmost item is evicted.
 
         Example:
             >>> oset = OrderedDequeSet()
-            >>> oset.append(3)
+            >>> oset.add(3)
             0
             >>> print(oset)
             OrderedDequeSet([3])
+            >>> oset = OrderedDequeSet([1, 2, 3], maxlen=3, on_evict=print)
+            >>> oset.add(4)
+            1
+            2
+            >>> 1 in oset, oset.index(4)
+            (False, 2)
         """
-        if key not in self.map:
-            self.map[key] = len(self.items)
-            self.items.append(key)
-        return self.map[key]
+        if key in self.map:
+            return self._logical(self.map[key])
+        if self._full():
+            self._evicted(self._evict_left())
+        self._touch()
+        self.map[key] = self._base + len(self.items)
+        self.items.append(key)
+        return len(self) - 1
 
-    @refresh_index
     def addleft(self, key: T) -> int:
         """
-        Add `key` as an item to this OrderedDequeSet, then return its index.
+        Add `key` as an item to the left of this OrderedDequeSet, then return its
+        index.
 
         If `key` is already in the OrderedDequeSet, return the index it already
-        had.
+        had. If the set is full, the rightmost item is evicted.
 
         Example:
             >>> oset = OrderedDequeSet([3, 4, 5])
@@ -245,11 +508,75 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
             0
             >>> print(oset)
             OrderedDequeSet([2, 3, 4, 5])
+            >>> oset.index(5)
+            3
+        """
+        if key in self.map:
+            return self._logical(self.map[key])
+        if self._full():
+            self._evicted(self._evict_right())
+        self._touch()
+        self._base -= 1
+        self.map[key] = self._base
+        self.items.appendleft(key)
+        return 0
+
+    def merge(self, sequence: SetLike[T]) -> List[T]:
+        """
+        Append every item of `sequence` that is not already present, in a single
+        pass, and return the list of items that were actually inserted.
+
+        Duplicates are checked against the existing index as the items are
+        placed, and maxlen eviction is applied once at the end instead of per
+        item. Items that would be pushed straight back out by maxlen are not
+        reported as inserted.
+
+        Example:
+            >>> oset = OrderedDequeSet([1, 2, 3], maxlen=4)
+            >>> oset.merge([3, 4, 4, 5])
+            [4, 5]
+            >>> print(oset)
+            OrderedDequeSet([2, 3, 4, 5])
         """
-        if key not in self.map:
-            self.items.appendleft(key)
-            self.map[key] = 0
-        return self.map[key]  # should always be 0
+        try:
+            iterator = iter(sequence)
+        except TypeError:
+            raise ValueError("Argument needs to be an iterable, got %s" % type(sequence))
+        # Collected before the index is touched, so an unhashable item or a failing
+        # iterator leaves the set as it was
+        seen = self.map
+        fresh = list({item: None for item in iterator if item not in seen})
+        end = self._base + len(self.items)
+        for i, item in enumerate(fresh, end):
+            self.map[item] = i
+
+        if self._maxlen is not None:
+            if self._holes and len(self.items) + len(fresh) > self._maxlen:
+                self.compact()
+                end = self._base + len(self.items)
+                for i, item in enumerate(fresh, end):
+                    self.map[item] = i
+            existing = len(self.items)
+            overflow = existing + len(fresh) - self._maxlen
+            for _ in range(min(overflow, existing)):
+                self._evicted(self._evict_left())
+            if overflow > existing:
+                dropped = len(fresh) - self._maxlen
+                for item in fresh[:dropped]:
+                    del self.map[item]
+                self._base += dropped
+                fresh = fresh[dropped:]
+
+        if fresh:
+            self._touch()
+            self.items.extend(fresh)
+        return fresh
+
+    extend = merge
+
+    def __ior__(self, other: SetLike[T]) -> "OrderedDequeSet[T]":
+        self.merge(other)
+        return self
 
     def update(self, sequence: SetLike[T]) -> int:
         """
@@ -295,7 +622,7 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         """
         if isinstance(key, Iterable) and not _is_atomic(key):
             return [self.index(subkey) for subkey in key]
-        return self.map[key]
+        return self._logical(self.map[key])
 
     # Provide some compatibility with pd.Index
     get_loc = index
@@ -316,12 +643,8 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         if not self.items:
             raise KeyError("Set is empty")
 
-        elem = self.items[index]
-        del self.items[index]
-        del self.map[elem]
-        return elem
+        return self._delete_slot(self._physical(index))
 
-    @refresh_index
     def popleft(self):
         """
         Remove and return item at index 0.
@@ -336,9 +659,7 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
             >>> oset
             OrderedDequeSet([2, 3])
         """
-        elem = self.items.popleft()
-        del self.map[elem]
-        return elem
+        return self._evict_left()
 
     def discard(self, key: T) -> None:
         """
@@ -356,20 +677,18 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
             >>> print(oset)
             OrderedDequeSet([1, 3])
         """
-        if key in self:
-            i = self.map[key]
-            del self.items[i]
-            del self.map[key]
-            for k, v in self.map.items():
-                if v >= i:
-                    self.map[k] = v - 1
+        if key in self.map:
+            self._delete_slot(self.map[key] - self._base)
 
     def clear(self) -> None:
         """
         Remove all items from this OrderedDequeSet.
         """
-        del self.items[:]
+        self._touch()
+        self.items.clear()
         self.map.clear()
+        self._base = 0
+        self._holes = []
 
     def __iter__(self) -> Iterator[T]:
         """
@@ -377,6 +696,8 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
             >>> list(iter(OrderedDequeSet([1, 2, 3])))
             [1, 2, 3]
         """
+        if self._holes:
+            return (item for item in self.items if item is not _TOMBSTONE)
         return iter(self.items)
 
     def __reversed__(self) -> Iterator[T]:
@@ -385,6 +706,8 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
             >>> list(reversed(OrderedDequeSet([1, 2, 3])))
             [3, 2, 1]
         """
+        if self._holes:
+            return (item for item in reversed(self.items) if item is not _TOMBSTONE)
         return reversed(self.items)
 
     def __repr__(self) -> str:
@@ -422,13 +745,15 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
 
     def reverse(self):
         """Reverses the OrderedDequeSet and returns the instance"""
+        self._touch()
+        self.compact()
         l, r = 0, len(self.items) - 1
         while l < r:
             lkey, rkey = self.items[l], self.items[r]
             self.items[l] = rkey
             self.items[r] = lkey
-            self.map[lkey] = r
-            self.map[rkey] = l
+            self.map[lkey] = self._base + r
+            self.map[rkey] = self._base + l
             l += 1
             r -= 1
         return self
@@ -450,12 +775,10 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
             >>> oset | {10}
             OrderedDequeSet([3, 1, 4, 5, 2, 0, 10])
         """
-        cls: type = OrderedDequeSet
-        if isinstance(self, OrderedDequeSet):
-            cls = self.__class__
-        containers = map(list, it.chain([self], sets))
-        items = it.chain.from_iterable(containers)
-        return cls(items, maxlen=self.maxlen)
+        result = self.copy()
+        for other in sets:
+            result.merge(other)
+        return result
 
     def __and__(self, other: SetLike[T]) -> "OrderedDequeSet[T]":
         # the parent implementation of this is backwards
@@ -564,8 +887,11 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         Replace the 'items' list of this OrderedDequeSet with a new one, updating
         self.map accordingly.
         """
-        self.items = items
-        self.map = {item: idx for (idx, item) in enumerate(items)}
+        self._touch()
+        self.items = deque(items, maxlen=self._maxlen)
+        self.map = {item: idx for (idx, item) in enumerate(self.items)}
+        self._base = 0
+        self._holes = []
 
     def difference_update(self, *sets: SetLike[T]) -> None:
         """
@@ -586,7 +912,7 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         for other in sets:
             items_as_set = set(other)  # type: Set[T]
             items_to_remove |= items_as_set
-        self._update_items([item for item in self.items if item not in items_to_remove])
+        self._update_items([item for item in self if item not in items_to_remove])
 
     def intersection_update(self, other: SetLike[T]) -> None:
         """
@@ -601,7 +927,7 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
             OrderedDequeSet([1, 3, 7])
         """
         other = set(other)
-        self._update_items([item for item in self.items if item in other])
+        self._update_items([item for item in self if item in other])
 
     def symmetric_difference_update(self, other: SetLike[T]) -> None:
         """
@@ -617,4 +943,599 @@ class OrderedDequeSet(MutableSet[T], Sequence[T]):
         """
         items_to_add = [item for item in other if item not in self]
         items_to_remove = set(other)
-        self._update_items([item for item in self.items if item not in items_to_remove] + items_to_add)
+        self._update_items([item for item in self if item not in items_to_remove] + items_to_add)
+
+
+class TimeOrderedDequeSet(OrderedDequeSet[T]):
+    """
+    An OrderedDequeSet that keeps its items sorted by a timestamp, extracted
+    from each item with `key` (by default the item's first element).
+
+    A parallel array of timestamps is maintained next to the deque, so time
+    window queries such as since(), between() and latest() are a bisect away
+    instead of a full scan. Items arriving out of order are inserted in their
+    sorted position, so the set never needs to be resorted.
+
+    Example:
+        >>> tset = TimeOrderedDequeSet([(3.0, "c"), (1.0, "a"), (2.0, "b")])
+        >>> tset
+        TimeOrderedDequeSet([(1.0, 'a'), (2.0, 'b'), (3.0, 'c')])
+        >>> tset.since(1.0)
+        [(2.0, 'b'), (3.0, 'c')]
+    """
+
+    timestamp_key: Callable[[T], float] = staticmethod(itemgetter(0))
+
+    def __init__(
+        self,
+        initial: OrderedDequeSetInitializer[T] = None,
+        maxlen=None,
+        key: Optional[Callable[[T], float]] = None,
+        on_evict: Optional[Callable[[T], Any]] = None,
+    ):
+        self.stamps = array("d")
+        if key is not None:
+            self.timestamp_key = key
+        super().__init__(initial, maxlen=maxlen, on_evict=on_evict)
+
+    def copy(self) -> "TimeOrderedDequeSet[T]":
+        """
+        Return a shallow copy of this object, keeping its timestamp key.
+        """
+        return self.__class__(self, maxlen=self.maxlen, key=self.timestamp_key)
+
+    def _popleft_slot(self) -> Any:
+        del self.stamps[0]
+        return super()._popleft_slot()
+
+    def _pop_slot(self) -> Any:
+        self.stamps.pop()
+        return super()._pop_slot()
+
+    def compact(self) -> None:
+        if self._holes:
+            self.stamps = array(
+                "d", (stamp for stamp, item in zip(self.stamps, self.items) if item is not _TOMBSTONE)
+            )
+        super().compact()
+
+    def add(self, key: T) -> int:
+        """
+        Insert `key` at the position given by its timestamp, then return its
+        index. Items sharing a timestamp keep their insertion order.
+
+        If the set is full the oldest item is evicted; if `key` is older than
+        everything in a full set, it is not added and -1 is returned.
+
+        Example:
+            >>> tset = TimeOrderedDequeSet([(1.0, "a"), (3.0, "c")])
+            >>> tset.add((2.0, "b"))
+            1
+            >>> tset.index((3.0, "c"))
+            2
+        """
+        if key in self.map:
+            return self._logical(self.map[key])
+
+        stamp = self.timestamp_key(key)
+        if self._full():
+            if bisect_right(self.stamps, stamp) == 0:
+                return -1
+            self._evicted(self._evict_left())
+        i = bisect_right(self.stamps, stamp)
+
+        self._touch()
+        n = len(self.items)
+        if i == n:
+            self.map[key] = self._base + n
+            self.items.append(key)
+            self.stamps.append(stamp)
+            return len(self) - 1
+
+        self.items.insert(i, key)
+        self.stamps.insert(i, stamp)
+        # Shift whichever side of the insertion point is shorter, tombstones included
+        split = bisect_left(self._holes, self._base + i)
+        if i < n - i:
+            self._base -= 1
+            for j in range(i):
+                item = self.items[j]
+                if item is not _TOMBSTONE:
+                    self.map[item] -= 1
+            for h in range(split):
+                self._holes[h] -= 1
+        else:
+            for j in range(i + 1, n + 1):
+                item = self.items[j]
+                if item is not _TOMBSTONE:
+                    self.map[item] += 1
+            for h in range(split, len(self._holes)):
+                self._holes[h] += 1
+        self.map[key] = self._base + i
+        return self._logical(self.map[key])
+
+    def addleft(self, key: T) -> int:
+        """
+        Items are positioned by timestamp, so this is the same as add().
+        """
+        return self.add(key)
+
+    def merge(self, sequence: SetLike[T]) -> List[T]:
+        """
+        Insert every item of `sequence` not already present and return the
+        items that were actually inserted, oldest first.
+
+        When the new items are all at least as new as the current newest item
+        (the common case for a polling loop) they are appended in one pass;
+        otherwise each one is placed with a sorted insert.
+
+        Example:
+            >>> tset = TimeOrderedDequeSet([(1.0, "a"), (2.0, "b")], maxlen=3)
+            >>> tset.merge([(2.0, "b"), (3.0, "c"), (4.0, "d")])
+            [(3.0, 'c'), (4.0, 'd')]
+            >>> tset
+            TimeOrderedDequeSet([(2.0, 'b'), (3.0, 'c'), (4.0, 'd')])
+        """
+        fresh = [item for item in dict.fromkeys(sequence) if item not in self.map]
+        stamps = [self.timestamp_key(item) for item in fresh]
+        newest = self.latest_timestamp
+        in_order = all(a <= b for a, b in zip(stamps, stamps[1:]))
+        if in_order and (newest is None or not stamps or stamps[0] >= newest):
+            inserted = super().merge(fresh)
+            self.stamps.extend(stamps[len(stamps) - len(inserted) :])
+            return inserted
+
+        for item in fresh:
+            self.add(item)
+        return sorted((item for item in fresh if item in self.map), key=self.timestamp_key)
+
+    def reverse(self):
+        raise TypeError("A TimeOrderedDequeSet cannot be reversed")
+
+    def clear(self) -> None:
+        super().clear()
+        self.stamps = array("d")
+
+    def _update_items(self, items: list) -> None:
+        super()._update_items(items)
+        self.stamps = array("d", map(self.timestamp_key, self.items))
+
+    def _window(self, lo: int, hi: int) -> List[T]:
+        """Return the items between positions lo and hi of self.items, walking from the nearest end"""
+        n = len(self.items)
+        if lo >= n - hi:
+            window = list(it.islice(reversed(self.items), n - hi, n - lo))
+            window.reverse()
+        else:
+            window = list(it.islice(self.items, lo, hi))
+        if self._holes:
+            return [item for item in window if item is not _TOMBSTONE]
+        return window
+
+    def since(self, timestamp: float) -> List[T]:
+        """
+        Return the items strictly newer than `timestamp`, oldest first.
+
+        Example:
+            >>> tset = TimeOrderedDequeSet([(1.0, "a"), (2.0, "b"), (3.0, "c")])
+            >>> tset.since(2.0)
+            [(3.0, 'c')]
+        """
+        return self._window(bisect_right(self.stamps, timestamp), len(self.items))
+
+    def between(self, start: float, end: float) -> List[T]:
+        """
+        Return the items with start <= timestamp <= end, oldest first.
+
+        Example:
+            >>> tset = TimeOrderedDequeSet([(1.0, "a"), (2.0, "b"), (3.0, "c")])
+            >>> tset.between(1.5, 3.0)
+            [(2.0, 'b'), (3.0, 'c')]
+        """
+        return self._window(bisect_left(self.stamps, start), bisect_right(self.stamps, end))
+
+    def latest(self, n: int) -> List[T]:
+        """
+        Return the `n` newest items, oldest first.
+
+        Example:
+            >>> TimeOrderedDequeSet([(1.0, "a"), (2.0, "b"), (3.0, "c")]).latest(2)
+            [(2.0, 'b'), (3.0, 'c')]
+        """
+        n = max(0, min(n, len(self)))
+        window = list(it.islice(reversed(self), n))
+        window.reverse()
+        return window
+
+    @property
+    def latest_timestamp(self) -> Optional[float]:
+        """Timestamp of the newest item, or None if the set is empty"""
+        return self.stamps[-1] if self.stamps else None
+
+
+def _locked(name: str):
+    """Wrap the OrderedDequeSet method `name` so it runs as a single write"""
+    method = getattr(OrderedDequeSet, name)
+
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._writing():
+            return method(self, *args, **kwargs)
+
+    return locked
+
+
+class ThreadSafeOrderedDequeSet(OrderedDequeSet[T]):
+    """
+    An OrderedDequeSet that can be shared between the event loop and worker
+    threads.
+
+    Writers serialize on a reentrant lock and bump a sequence number before
+    and after every write, seqlock style. Readers never take the lock on the
+    fast path: they read optimistically and only retry, and eventually fall
+    back to the lock, if a write overlapped the read. Iteration goes through
+    snapshot(), so a reader always sees one consistent version of the set.
+
+    Example:
+        >>> oset = ThreadSafeOrderedDequeSet([1, 2, 3], maxlen=3)
+        >>> oset.add(4)
+        2
+        >>> list(oset), 1 in oset, oset[-1]
+        ([2, 3, 4], False, 4)
+    """
+
+    # Optimistic attempts a reader makes before waiting for the lock
+    optimistic_reads = 4
+
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.RLock()
+        self._seq = 0  # odd while a write is in progress
+        self._depth = 0
+        self._published: Tuple[int, Tuple[T, ...]] = (-1, ())
+        self._listeners: List[Callable[[], Any]] = []
+        super().__init__(*args, **kwargs)
+
+    @contextmanager
+    def _writing(self):
+        with self._lock:
+            self._depth += 1
+            outermost = self._depth == 1
+            if outermost:
+                self._seq += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if outermost:
+                    self._seq += 1
+        if outermost:
+            for listener in self._listeners:
+                listener()
+
+    def _read_at(self, fn: Callable[..., Any], *args: Any) -> Tuple[int, Any]:
+        """
+        Run the read-only `fn`, retrying if a write overlapped it, and return
+        the sequence number it was read at along with its result. That number
+        is only odd if the read was made from inside a write, by the writer.
+        """
+        for _ in range(self.optimistic_reads):
+            seq = self._seq
+            if seq & 1:
+                continue
+            try:
+                result = fn(*args)
+            except Exception:
+                if self._seq == seq:
+                    raise
+                continue
+            if self._seq == seq:
+                return seq, result
+        with self._lock:
+            return self._seq, fn(*args)
+
+    def _read(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run the read-only `fn`, retrying if a write overlapped it"""
+        return self._read_at(fn, *args)[1]
+
+    def add_listener(self, listener: Callable[[], Any]) -> None:
+        """Call `listener` with no arguments after every completed write"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[], Any]) -> None:
+        self._listeners.remove(listener)
+
+    add = _locked("add")
+    addleft = _locked("addleft")
+    merge = _locked("merge")
+    extend = merge
+    pop = _locked("pop")
+    popleft = _locked("popleft")
+    discard = _locked("discard")
+    clear = _locked("clear")
+    reverse = _locked("reverse")
+    compact = _locked("compact")
+    difference_update = _locked("difference_update")
+    intersection_update = _locked("intersection_update")
+    symmetric_difference_update = _locked("symmetric_difference_update")
+    _update_items = _locked("_update_items")
+
+    @OrderedDequeSet.maxlen.setter
+    def maxlen(self, value: int):
+        with self._writing():
+            OrderedDequeSet.maxlen.fset(self, value)
+
+    def _view(self) -> Tuple[T, ...]:
+        return tuple(OrderedDequeSet.__iter__(self))
+
+    def snapshot(self) -> Tuple[T, ...]:
+        seq, view = self._published
+        if seq == self._seq:
+            return view
+        seq, view = self._read_at(self._view)
+        # Only views read at an even sequence number, with no write in
+        # progress, are published; one taken by a writer mid-write is not.
+        if not seq & 1:
+            self._published = (seq, view)
+        return view
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self.snapshot())
+
+    def __reversed__(self) -> Iterator[T]:
+        return reversed(self.snapshot())
+
+    def __len__(self):
+        return self._read(super().__len__)
+
+    def __contains__(self, key: Any) -> bool:
+        return self._read(super().__contains__, key)
+
+    def __getitem__(self, index):
+        return self._read(super().__getitem__, index)
+
+    def index(self, key):
+        return self._read(super().index, key)
+
+    get_loc = index
+    get_indexer = index
+
+
+class AsyncDequeSetView:
+    """
+    Lets coroutines wait for a ThreadSafeOrderedDequeSet to change, whether the
+    write happened on the event loop or in a worker thread, instead of polling
+    it. Reads are served from the set's lock-free snapshots, and writes can be
+    made on the set directly: its lock is only ever held for one in-memory
+    update, never across an await.
+
+    Must be created while the event loop it will be awaited on is running.
+    """
+
+    def __init__(self, oset: ThreadSafeOrderedDequeSet[T]):
+        self.oset = oset
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        oset.add_listener(self._notify)
+
+    def _notify(self) -> None:
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    def close(self) -> None:
+        """Stop listening for changes to the underlying set"""
+        self.oset.remove_listener(self._notify)
+
+    def snapshot(self) -> Tuple[T, ...]:
+        return self.oset.snapshot()
+
+    async def wait_for_change(self, version: int, timeout: Optional[float] = None) -> Tuple[int, Tuple[T, ...]]:
+        """
+        Wait until the set's version differs from `version`, then return the new
+        version and a snapshot. Raises asyncio.TimeoutError after `timeout`
+        seconds without a change.
+        """
+        while self.oset.version == version:
+            self._changed.clear()
+            if self.oset.version != version:
+                break
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        return self.oset.version, self.oset.snapshot()
+
+
+class DequeSetRegistry(MutableMapping):
+    """
+    A mapping of keys to OrderedDequeSets. Like a defaultdict, a set is created
+    on first access, with the registry's `maxlen`.
+
+    The registry itself can be bounded as well: `max_keys` caps the number of
+    sets and `max_items` caps the total number of items across all of them.
+    When either limit is exceeded the least recently accessed sets are dropped.
+    Limits are enforced whenever a new key is created and whenever trim() is
+    called, so a caller that mostly grows existing sets should trim()
+    periodically.
+
+    Readers that only care about what changed can call changed_since() with
+    the versions they have already seen, and get back cheap immutable
+    snapshots of just the sets that were modified in the meantime.
+
+    The registry is not thread-safe, even with a factory that makes
+    thread-safe sets: every access reorders it, so it should only be used
+    from one thread, such as the event loop's.
+
+    Example:
+        >>> registry = DequeSetRegistry(maxlen=2)
+        >>> registry["a"].merge([1, 2, 3])
+        [2, 3]
+        >>> seen = {}
+        >>> [(key, view) for key, version, view in registry.changed_since(seen)]
+        [('a', (2, 3))]
+        >>> seen["a"] = registry["a"].version
+        >>> registry.changed_since(seen)
+        []
+
+        >>> registry = DequeSetRegistry(maxlen=10, max_keys=2)
+        >>> registry["a"].add(1), registry["b"].add(2), registry["a"].add(3)
+        (0, 0, 1)
+        >>> registry["c"].add(4)
+        0
+        >>> list(registry), registry.stats()["items"]
+        (['a', 'c'], 3)
+    """
+
+    def __init__(
+        self,
+        maxlen=None,
+        factory: Callable[..., OrderedDequeSet] = OrderedDequeSet,
+        max_keys: Optional[int] = None,
+        max_items: Optional[int] = None,
+    ):
+        self.maxlen = maxlen
+        self.factory = factory
+        self.max_keys = max_keys
+        self.max_items = max_items
+        # Kept in least to most recently accessed order
+        self._sets: "OrderedDict[Hashable, OrderedDequeSet]" = OrderedDict()
+
+    def __getitem__(self, key: Hashable) -> OrderedDequeSet:
+        try:
+            oset = self._sets[key]
+        except KeyError:
+            oset = self._sets[key] = self.factory(maxlen=self.maxlen)
+            self.trim()
+        else:
+            self._sets.move_to_end(key)
+        return oset
+
+    def __setitem__(self, key: Hashable, value: OrderedDequeSet) -> None:
+        self._sets[key] = value
+        self._sets.move_to_end(key)
+        self.trim()
+
+    def __delitem__(self, key: Hashable) -> None:
+        del self._sets[key]
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._sets
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._sets)
+
+    def __len__(self) -> int:
+        return len(self._sets)
+
+    def __repr__(self) -> str:
+        return "%s(%r)" % (self.__class__.__name__, self._sets)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Look up `key` without creating a set for it"""
+        return self._sets.get(key, default)
+
+    def items(self):
+        """Iterate over (key, set) pairs without counting it as an access"""
+        return self._sets.items()
+
+    def values(self):
+        """Iterate over the sets without counting it as an access"""
+        return self._sets.values()
+
+    def pop(self, key: Hashable, *default: Any) -> Any:
+        """Remove `key` and return its set, without creating one if it is absent"""
+        return self._sets.pop(key, *default)
+
+    def item_count(self) -> int:
+        """Total number of items across every set in the registry"""
+        return sum(len(oset) for oset in self._sets.values())
+
+    def trim(self) -> int:
+        """
+        Drop least recently accessed sets until the registry is within
+        `max_keys` and `max_items`, and return how many were dropped.
+        """
+        dropped = 0
+        if self.max_keys is not None:
+            while len(self._sets) > self.max_keys:
+                self._sets.popitem(last=False)
+                dropped += 1
+        if self.max_items is not None:
+            total = self.item_count()
+            while total > self.max_items and self._sets:
+                _, oset = self._sets.popitem(last=False)
+                total -= len(oset)
+                dropped += 1
+        return dropped
+
+    def nbytes(self) -> int:
+        """
+        Approximate memory held by the registry: its containers plus every item,
+        with tuple items counted one level deep.
+        """
+        size = sys.getsizeof(self._sets)
+        for oset in self._sets.values():
+            size += sys.getsizeof(oset)
+            for item in oset:
+                size += sys.getsizeof(item)
+                if isinstance(item, tuple):
+                    size += sum(map(sys.getsizeof, item))
+        return size
+
+    def stats(self) -> Dict[str, int]:
+        """Current key, item and approximate byte counts, for monitoring"""
+        return {"keys": len(self._sets), "items": self.item_count(), "bytes": self.nbytes()}
+
+    def dump(self, fp: BinaryIO) -> None:
+        """
+        Write every set in the registry to the binary file `fp`, as a header
+        followed by a length-prefixed key and snapshot for each set.
+        """
+        fp.write(_REGISTRY_HEADER.pack(_REGISTRY_MAGIC, SNAPSHOT_VERSION, len(self._sets)))
+        for key, oset in self._sets.items():
+            for blob in (pickle.dumps(key, pickle.HIGHEST_PROTOCOL), oset.to_bytes()):
+                fp.write(_RECORD_LENGTH.pack(len(blob)))
+                fp.write(blob)
+
+    def load(self, fp: BinaryIO) -> int:
+        """
+        Restore sets written by dump() from the binary file `fp` into this
+        registry, using its factory, and return how many were loaded. Sets are
+        bulk-loaded, so no item goes through add().
+
+        Example:
+            >>> import io
+            >>> buf = io.BytesIO()
+            >>> registry = DequeSetRegistry(maxlen=3)
+            >>> registry["a"].merge([1, 2, 3, 4])
+            [2, 3, 4]
+            >>> registry.dump(buf)
+            >>> restored = DequeSetRegistry()
+            >>> restored.load(io.BytesIO(buf.getvalue()))
+            1
+            >>> restored["a"], restored["a"].maxlen
+            (OrderedDequeSet([2, 3, 4]), 3)
+        """
+        magic, version, count = _REGISTRY_HEADER.unpack(fp.read(_REGISTRY_HEADER.size))
+        if magic != _REGISTRY_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported registry snapshot (magic %r, version %d)" % (magic, version))
+        with _gc_paused():
+            for _ in range(count):
+                (length,) = _RECORD_LENGTH.unpack(fp.read(_RECORD_LENGTH.size))
+                key = pickle.loads(fp.read(length))
+                (length,) = _RECORD_LENGTH.unpack(fp.read(_RECORD_LENGTH.size))
+                self._sets[key] = self.factory.from_bytes(fp.read(length))
+        self.trim()
+        return count
+
+    def versions(self) -> Dict[Hashable, int]:
+        """Return the current version of every set in the registry"""
+        return {key: oset.version for key, oset in self._sets.items()}
+
+    def changed_since(self, seen: Dict[Hashable, int]) -> List[Tuple[Hashable, int, Tuple[Any, ...]]]:
+        """
+        Return (key, version, snapshot) for every set whose version differs from
+        the one recorded for it in `seen`. Sets that have not changed are skipped
+        without being touched.
+        """
+        return [
+            (key, oset.version, oset.snapshot())
+            for key, oset in list(self._sets.items())
+            if seen.get(key) != oset.version
+        ]
@@ -0,0 +1,276 @@
+"""
+Fan-out of tweet embeds to Discord channels.
+
+Messages are queued per channel and sent by a fixed pool of workers, so a
+burst to hundreds of channels cannot flood discord.py's rate limiter with
+thousands of tasks. A channel is only ever served by one worker at a time,
+which keeps its messages in order. When a channel has a backlog, up to 10
+queued embeds go out together as one message.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+import discord
+
+import metrics
+from tweets import Tweet
+
+# Discord allows at most 10 embeds, totalling 6000 characters, per message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS = 6000
+
+TWEET_COLOUR = discord.Colour.from_rgb(52, 61, 65)
+
+# A queued embed: (content, embed, key passed to on_sent)
+_Queued = Tuple[str, discord.Embed, Hashable]
+
+
+def render_tweet(tweet: Tweet) -> Tuple[str, discord.Embed]:
+    """The message content and embed posted for a tweet"""
+    embed = discord.Embed(
+        colour=TWEET_COLOUR,
+        timestamp=datetime.fromtimestamp(tweet.timestamp),
+        title=f"@{tweet.screen_name}",
+        url=tweet.url,
+        description=tweet.text,
+        type="rich",
+    )
+    return tweet.url, embed
+
+
+class RenderCache:
+    """
+    Rendered messages by tweet id, so a tweet is rendered once however many
+    channels it is sent to. Every channel is handed the same Embed instance.
+
+    Nothing expires on its own: forget() drops a tweet, and the cog hands it to
+    the recency buffer as on_evict, so the cache holds at most the tweets that
+    are still in the buffer.
+    """
+
+    def __init__(self, render: Callable[[Tweet], Tuple[str, discord.Embed]] = render_tweet):
+        self.render = render
+        self._rendered: Dict[int, Tuple[str, discord.Embed]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tweet: Tweet) -> Tuple[str, discord.Embed]:
+        rendered = self._rendered.get(tweet.id)
+        if rendered is None:
+            rendered = self._rendered[tweet.id] = self.render(tweet)
+            self.misses += 1
+        else:
+            self.hits += 1
+        return rendered
+
+    def forget(self, tweet: Tweet) -> None:
+        self._rendered.pop(tweet.id, None)
+
+    def __len__(self) -> int:
+        return len(self._rendered)
+
+    def stats(self) -> dict:
+        return {"cached": len(self._rendered), "hits": self.hits, "misses": self.misses}
+
+
+class TokenBucket:
+    """
+    Allows `rate` sends per second with bursts of up to `capacity`.
+
+    Example:
+        >>> bucket = TokenBucket(capacity=2, rate=1.0)
+        >>> bucket.delay(now=0.0), bucket.take(now=0.0), bucket.take(now=0.0), bucket.delay(now=0.0)
+        (0.0, None, None, 1.0)
+    """
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = None
+
+    def _refill(self, now: float) -> None:
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float = None) -> float:
+        """Seconds until a send is allowed"""
+        self._refill(time.monotonic() if now is None else now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float = None) -> None:
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= 1
+
+
+class Dispatcher:
+    """
+    Per-channel FIFO queues drained by `workers` tasks.
+
+    Each channel gets a token bucket sized to Discord's per-channel message
+    limit (5 per 5 seconds), so workers wait out a channel's limit without
+    sending into it. Sends that fail with a 429, a server error or a dropped
+    connection are retried with jittered exponential backoff, at the front of
+    the channel's queue so ordering holds. Channels that are gone or forbidden
+    have their messages dropped. Failures are logged, never swallowed.
+    """
+
+    def __init__(
+        self,
+        get_channel: Callable[[int], Optional[discord.abc.Messageable]],
+        workers: int = 8,
+        max_batch: int = MAX_EMBEDS_PER_MESSAGE,
+        burst: int = 5,
+        rate: float = 1.0,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        on_sent: Optional[Callable[[Hashable], None]] = None,
+    ):
+        self.get_channel = get_channel
+        self.workers = workers
+        self.max_batch = max_batch
+        self.burst = burst
+        self.rate = rate
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        # Called with the key of every embed once the message carrying it is sent
+        self.on_sent = on_sent
+        self.queues: Dict[int, Deque[_Queued]] = {}
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.retries: Dict[int, int] = {}
+        # Channels with messages waiting and no worker on them
+        self._ready: Optional[asyncio.Queue] = None
+        self._scheduled = set()
+        self._tasks: List[asyncio.Task] = []
+        self.sent = 0
+        self.messages = 0
+        self.dropped = 0
+
+    def submit(self, channel_id: int, content: str, embed: discord.Embed, key: Hashable = None) -> None:
+        """Queue an embed for a channel; never blocks. `key` is passed to on_sent once it is sent"""
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.queues.setdefault(channel_id, deque()).append((content, embed, key))
+        self._schedule(channel_id)
+
+    def _schedule(self, channel_id: int, delay: float = 0.0) -> None:
+        # A channel is in the ready queue, waiting on a timer, or being served; never two at once
+        if channel_id in self._scheduled:
+            return
+        self._scheduled.add(channel_id)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, channel_id)
+        else:
+            self._ready.put_nowait(channel_id)
+
+    def _next_batch(self, queue: Deque[_Queued]) -> List[_Queued]:
+        batch = [queue.popleft()]
+        chars = len(batch[0][1])
+        while queue and len(batch) < self.max_batch and chars + len(queue[0][1]) <= MAX_EMBED_CHARS:
+            chars += len(queue[0][1])
+            batch.append(queue.popleft())
+        return batch
+
+    async def _worker(self) -> None:
+        while True:
+            channel_id = await self._ready.get()
+            self._scheduled.discard(channel_id)
+            queue = self.queues.get(channel_id)
+            if not queue:
+                self.queues.pop(channel_id, None)
+                continue
+
+            bucket = self.buckets.setdefault(channel_id, TokenBucket(self.burst, self.rate))
+            wait = bucket.delay()
+            if wait > 0:
+                self._schedule(channel_id, wait)
+                continue
+
+            # Claim the channel while sending so no other worker picks it up
+            self._scheduled.add(channel_id)
+            batch = self._next_batch(queue)
+            bucket.take()
+            delay = await self._send(channel_id, batch)
+            self._scheduled.discard(channel_id)
+            if delay is not None:
+                queue.extendleft(reversed(batch))
+            if queue:
+                self._schedule(channel_id, delay or 0.0)
+            else:
+                self.queues.pop(channel_id, None)
+
+    async def _send(self, channel_id: int, batch: List[_Queued]) -> Optional[float]:
+        """Send one message; returns the delay before retrying it, or None if it is done with"""
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            logging.warning(f"Dropping {len(batch)} embeds for unknown channel {channel_id}")
+            self.dropped += len(batch)
+            return None
+        started = time.perf_counter()
+        try:
+            await channel.send(content="\n".join(content for content, _, _ in batch), embeds=[embed for _, embed, _ in batch])
+        except (discord.Forbidden, discord.NotFound) as e:
+            logging.warning(f"Dropping {len(batch)} embeds for channel {channel_id}: {e}")
+            metrics.DISCORD_SEND_FAILURES.labels("dropped").inc()
+            self.dropped += len(batch)
+            return None
+        except (discord.HTTPException, OSError, asyncio.TimeoutError) as e:
+            status = getattr(e, "status", None)
+            retries = self.retries.get(channel_id, 0) + 1
+            if (status is not None and status != 429 and status < 500) or retries > self.max_retries:
+                logging.exception(f"Giving up on {len(batch)} embeds for channel {channel_id}")
+                metrics.DISCORD_SEND_FAILURES.labels("dropped").inc()
+                self.retries.pop(channel_id, None)
+                self.dropped += len(batch)
+                return None
+            self.retries[channel_id] = retries
+            backoff = min(self.base_backoff * 2 ** (retries - 1), self.max_backoff)
+            delay = random.uniform(backoff / 2, backoff)
+            logging.warning(f"Send to channel {channel_id} failed ({e!r}), retry {retries} in {delay:.1f}s")
+            metrics.DISCORD_SEND_FAILURES.labels("retried").inc()
+            return delay
+        except Exception:
+            logging.exception(f"Unexpected error sending to channel {channel_id}")
+            metrics.DISCORD_SEND_FAILURES.labels("dropped").inc()
+            self.dropped += len(batch)
+            return None
+        metrics.DISCORD_SEND_SECONDS.observe(time.perf_counter() - started)
+        self.retries.pop(channel_id, None)
+        self.sent += len(batch)
+        self.messages += 1
+        if self.on_sent is not None:
+            for _, _, key in batch:
+                if key is not None:
+                    self.on_sent(key)
+        return None
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._ready = None
+        self._scheduled.clear()
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self.queues),
+            "pending": self.pending(),
+            "sent": self.sent,
+            "messages": self.messages,
+            "dropped": self.dropped,
+        }
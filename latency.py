@@ -0,0 +1,225 @@
+"""
+How long tweets take to get from Twitter to Discord and to SMS, stage by stage.
+
+Each tweet is stamped as it moves through the pipeline:
+
+    created   when it was posted (tweet.timestamp)
+    fetched   when a poll, or the stream, handed it to the bot
+    detected  when tweet_fetcher found it was new
+    enqueued  when its embed was queued for every subscribed channel
+
+and every channel.send or send_sms that completes for it is a delivery.
+The gaps between stamps are the stages below. Each one is kept in a window
+of recent samples, overall and per account, which the rolling percentiles
+are read from, and is also observed into a Prometheus histogram.
+"""
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import metrics
+
+# stage: (stamp it starts at, stamp it ends at)
+STAGES = {
+    "fetch": ("created", "fetched"),
+    "detect": ("fetched", "detected"),
+    "enqueue": ("detected", "enqueued"),
+    "discord": ("enqueued", "sent to Discord"),
+    "sms": ("detected", "sent by SMS"),
+    "discord_total": ("created", "sent to Discord"),
+    "sms_total": ("created", "sent by SMS"),
+}
+# The stages that add up to each end-to-end total, for the slow-stage report
+PATHS = {"discord_total": ("fetch", "detect", "enqueue", "discord"), "sms_total": ("fetch", "detect", "sms")}
+PERCENTILES = (50, 95, 99)
+
+_CREATED, _SCREEN_NAME, _FETCHED, _DETECTED, _ENQUEUED = range(5)
+
+
+class RollingWindow:
+    """
+    The last `size` samples in a ring buffer. Percentiles are nearest-rank,
+    computed from a sorted copy when asked for.
+
+    Example:
+        >>> window = RollingWindow(4)
+        >>> for seconds in (9.0, 1.0, 4.0, 2.0, 3.0):
+        ...     window.add(seconds)
+        >>> len(window), window.percentiles((50, 95, 100))
+        (4, [2.0, 4.0, 4.0])
+    """
+
+    __slots__ = ("samples", "size", "next")
+
+    def __init__(self, size: int):
+        self.samples: List[float] = []
+        self.size = size
+        self.next = 0
+
+    def add(self, value: float) -> None:
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            self.samples[self.next] = value
+            self.next = (self.next + 1) % self.size
+
+    def percentiles(self, percents: Sequence[float] = PERCENTILES) -> List[float]:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return [math.nan for _ in percents]
+        return [ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)] for percent in percents]
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+
+class LatencyTracker:
+    """
+    Stamps of up to `max_tweets` recent tweets, by id, and rolling windows of
+    the last `window` samples of each stage, plus the last `account_window`
+    per stage for every account. A tweet whose stamps have been dropped just
+    stops contributing samples. All methods are meant to run on the event loop.
+    """
+
+    def __init__(self, max_tweets: int = 10_000, window: int = 1024, account_window: int = 64):
+        self.max_tweets = max_tweets
+        self.window = window
+        self.account_window = account_window
+        self._stamps: "OrderedDict[int, list]" = OrderedDict()
+        self.stages: Dict[str, RollingWindow] = {}
+        self.accounts: Dict[str, Dict[str, RollingWindow]] = {}
+
+    def _entry(self, tweet) -> list:
+        entry = self._stamps.get(tweet.id)
+        if entry is None:
+            entry = self._stamps[tweet.id] = [tweet.timestamp, tweet.screen_name, None, None, None]
+            if len(self._stamps) > self.max_tweets:
+                self._stamps.popitem(last=False)
+        return entry
+
+    def _record(self, stage: str, screen_name: str, start: Optional[float], end: float) -> None:
+        if start is None:
+            return
+        # Twitter's clock and ours disagree a little, which must not give negative stages
+        seconds = max(0.0, end - start)
+        metrics.DELIVERY_STAGE_SECONDS.labels(stage).observe(seconds)
+        window = self.stages.get(stage)
+        if window is None:
+            window = self.stages[stage] = RollingWindow(self.window)
+        window.add(seconds)
+        by_stage = self.accounts.setdefault(screen_name, {})
+        window = by_stage.get(stage)
+        if window is None:
+            window = by_stage[stage] = RollingWindow(self.account_window)
+        window.add(seconds)
+
+    def fetched(self, tweets: Iterable, at: float = None) -> None:
+        """Stamp tweets as fetched, unless an earlier poll already returned them"""
+        at = time.time() if at is None else at
+        for tweet in tweets:
+            entry = self._entry(tweet)
+            if entry[_FETCHED] is None:
+                entry[_FETCHED] = at
+
+    def detected(self, tweets: Iterable, at: float = None) -> None:
+        at = time.time() if at is None else at
+        for tweet in tweets:
+            entry = self._entry(tweet)
+            entry[_DETECTED] = at
+            self._record("fetch", entry[_SCREEN_NAME], entry[_CREATED], entry[_FETCHED] or at)
+            self._record("detect", entry[_SCREEN_NAME], entry[_FETCHED], at)
+
+    def enqueued(self, tweet, at: float = None) -> None:
+        at = time.time() if at is None else at
+        entry = self._entry(tweet)
+        entry[_ENQUEUED] = at
+        self._record("enqueue", entry[_SCREEN_NAME], entry[_DETECTED], at)
+
+    def sent_to_discord(self, tweet_id: int, at: float = None) -> None:
+        """A channel.send carrying this tweet completed"""
+        self._delivered(tweet_id, "discord", _ENQUEUED, at)
+
+    def sent_by_sms(self, tweet_id: int, at: float = None) -> None:
+        """A send_sms of this tweet completed"""
+        self._delivered(tweet_id, "sms", _DETECTED, at)
+
+    def _delivered(self, tweet_id: int, stage: str, since: int, at: Optional[float]) -> None:
+        entry = self._stamps.get(tweet_id)
+        if entry is None:
+            return
+        at = time.time() if at is None else at
+        self._record(stage, entry[_SCREEN_NAME], entry[since], at)
+        self._record(f"{stage}_total", entry[_SCREEN_NAME], entry[_CREATED], at)
+
+    def report(self, screen_name: str = None) -> Dict[str, Tuple[int, List[float]]]:
+        """{stage: (samples, [p50, p95, p99])}, overall or for one account"""
+        windows = self.stages if screen_name is None else self.accounts.get(screen_name, {})
+        return {stage: (len(windows[stage]), windows[stage].percentiles()) for stage in STAGES if stage in windows}
+
+    def slow_stages(self, screen_name: str = None) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        For each end-to-end path, every stage's share of the sum of the stage
+        medians, largest first, so whichever of polling, fan-out or Twilio
+        dominates comes out on top.
+        """
+        report = self.report(screen_name)
+        shares = {}
+        for total, stages in PATHS.items():
+            if total not in report:
+                continue
+            medians = {stage: report[stage][1][0] for stage in stages if stage in report}
+            overall = sum(medians.values())
+            if overall > 0:
+                shares[total] = sorted(((stage, median / overall) for stage, median in medians.items()), key=lambda item: -item[1])
+        return shares
+
+    def slowest_accounts(self, stage: str = "discord_total", count: int = 5) -> List[Tuple[str, float]]:
+        """The accounts with the highest p95 for `stage`"""
+        p95s = [
+            (screen_name, windows[stage].percentiles((95,))[0])
+            for screen_name, windows in self.accounts.items()
+            if stage in windows
+        ]
+        return sorted(p95s, key=lambda item: -item[1])[:count]
+
+    def summary(self, screen_name: str = None) -> List[str]:
+        """
+        Lines for the admin channel: percentiles per stage, the slow-stage
+        report and, overall, the accounts slowest to reach Discord.
+
+        Example:
+            >>> from tweets import Tweet
+            >>> tracker = LatencyTracker()
+            >>> tweet = Tweet(100.0, "nasa", 1, "liftoff")
+            >>> tracker.fetched([tweet], at=160.0)
+            >>> tracker.detected([tweet], at=160.5)
+            >>> tracker.enqueued(tweet, at=160.5)
+            >>> tracker.sent_to_discord(1, at=161.5)
+            >>> print("\\n".join(tracker.summary()))
+            stage: samples p50/p95/p99 seconds
+            fetch: 1 60.00/60.00/60.00
+            detect: 1 0.50/0.50/0.50
+            enqueue: 1 0.00/0.00/0.00
+            discord: 1 1.00/1.00/1.00
+            discord_total: 1 61.50/61.50/61.50
+            discord_total is mostly fetch 98%, discord 2%, detect 1%, enqueue 0%
+            slowest to Discord (p95): nasa 61.50
+        """
+        report = self.report(screen_name)
+        if not report:
+            return [f"No deliveries timed{' for ' + screen_name if screen_name else ''} yet"]
+        lines = ["stage: samples p50/p95/p99 seconds"]
+        for stage, (samples, percentiles) in report.items():
+            lines.append(f"{stage}: {samples} " + "/".join(f"{seconds:.2f}" for seconds in percentiles))
+        for total, shares in self.slow_stages(screen_name).items():
+            lines.append(f"{total} is mostly " + ", ".join(f"{stage} {share:.0%}" for stage, share in shares))
+        if screen_name is None:
+            slowest = self.slowest_accounts()
+            if slowest:
+                lines.append("slowest to Discord (p95): " + ", ".join(f"{name} {seconds:.2f}" for name, seconds in slowest))
+        return lines
+
+
+# Shared by the fetchers, the dispatcher and both cogs
+tracker = LatencyTracker()
@@ -0,0 +1,126 @@
+"""
+Prometheus metrics for the tweet pipeline.
+
+Everything is registered on prometheus_client's default registry, and
+start_server() serves it in the Prometheus text format from a thread inside
+the bot process, on 127.0.0.1:9108 unless METRICS_ADDR/METRICS_PORT say
+otherwise. Values that can only be read safely on the event loop, like queue
+depths and buffer sizes, are sampled there by watch_event_loop() instead of
+by the thread answering the scrape.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, List
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
+
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+FETCH_SECONDS = Histogram("twiscord_fetch_seconds", "Time taken by one poll of the tweet source", buckets=LATENCY_BUCKETS)
+FETCH_TWEETS = Histogram(
+    "twiscord_fetch_tweets", "Tweets returned by one poll", buckets=(0, 1, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+FETCH_FAILURES = Counter("twiscord_fetch_failures", "Polls of the tweet source that raised")
+FETCH_BYTES = Counter("twiscord_fetch_bytes", "Bytes of timeline responses received from Twitter")
+TWEETS_INGESTED = Counter("twiscord_tweets_ingested", "New tweets taken into the pipeline")
+DEDUP_HITS = Counter("twiscord_dedup_hits", "Fetched tweets dropped because their id was already seen")
+DISPATCH_QUEUE = Gauge("twiscord_dispatch_queue_depth", "Embeds waiting to be sent to Discord")
+DISCORD_SEND_SECONDS = Histogram(
+    "twiscord_discord_send_seconds", "Time taken by one Discord message send", buckets=LATENCY_BUCKETS
+)
+DISCORD_SEND_FAILURES = Counter("twiscord_discord_send_failures", "Failed Discord sends, by what happened next", ["outcome"])
+SMS_SEND_SECONDS = Histogram("twiscord_sms_send_seconds", "Time taken to hand one SMS to Twilio", buckets=LATENCY_BUCKETS)
+LOOP_LAG = Histogram(
+    "twiscord_event_loop_lag_seconds",
+    "How late the event loop woke a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+DELIVERY_STAGE_SECONDS = Histogram(
+    "twiscord_delivery_stage_seconds",
+    "Time tweets spend in each stage between being posted and being delivered",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0, 120.0, 300.0),
+)
+REGISTRY_BYTES = Gauge("twiscord_registry_bytes", "Approximate memory held by a tweet buffer registry", ["registry"])
+REGISTRY_ITEMS = Gauge("twiscord_registry_items", "Items held by a tweet buffer registry", ["registry"])
+
+_samplers: List[Callable[[], None]] = []
+
+
+def on_sample(sampler: Callable[[], None]) -> None:
+    """Have watch_event_loop call `sampler` periodically, on the event loop, to update gauges"""
+    _samplers.append(sampler)
+
+
+def track_registry(name: str, registry) -> None:
+    """Report a DequeSetRegistry's size under `name`"""
+
+    def sample():
+        stats = registry.stats()
+        REGISTRY_BYTES.labels(name).set(stats["bytes"])
+        REGISTRY_ITEMS.labels(name).set(stats["items"])
+
+    on_sample(sample)
+
+
+async def watch_event_loop(interval: float = 0.5, sample_every: float = 15.0) -> None:
+    """
+    Runs until cancelled: sleeps `interval` seconds at a time and records how
+    much later than asked it woke up, and runs the samplers every
+    `sample_every` seconds.
+    """
+    sampled_at = 0.0
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
+        if started - sampled_at >= sample_every:
+            sampled_at = started
+            for sampler in _samplers:
+                try:
+                    sampler()
+                except Exception:
+                    logging.exception("Metrics sampler failed")
+
+
+def start_server(port: int = METRICS_PORT, addr: str = METRICS_ADDR) -> bool:
+    """Serve the metrics; returns False, and the bot runs without them, if the port cannot be bound"""
+    try:
+        start_http_server(port, addr=addr)
+    except OSError as e:
+        logging.warning(f"Could not serve metrics on {addr}:{port}: {e}")
+        return False
+    return True
+
+
+def summary() -> List[str]:
+    """One line per pipeline metric: counters and gauges with their values, histograms with count and mean"""
+    lines = []
+    for metric in REGISTRY.collect():
+        if not metric.name.startswith("twiscord_"):
+            continue
+        if metric.type == "histogram":
+            # Labelled histograms have a _count and _sum per label set
+            totals = {}
+            for sample in metric.samples:
+                labels = frozenset((key, value) for key, value in sample.labels.items() if key != "le")
+                totals[sample.name, labels] = sample.value
+            for name, labels in totals:
+                if name != f"{metric.name}_count":
+                    continue
+                count = totals[name, labels]
+                mean = totals.get((f"{metric.name}_sum", labels), 0) / count if count else 0.0
+                label_text = ",".join(f"{key}={value}" for key, value in sorted(labels))
+                lines.append(f"{metric.name}{'{' + label_text + '}' if label_text else ''}: {count:.0f} observed, mean {mean:.4g}")
+            continue
+        for sample in metric.samples:
+            if sample.name.endswith("_created"):
+                continue
+            labels = ",".join(f"{key}={value}" for key, value in sample.labels.items())
+            lines.append(f"{sample.name}{'{' + labels + '}' if labels else ''}: {sample.value:.6g}")
+    return lines
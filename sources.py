@@ -0,0 +1,480 @@
+"""
+Where Tweets.tweet_fetcher gets its tweets from.
+
+A TweetSource hands back the tweets that are new since its last poll and
+says how long to wait before polling again. ListSource reads the Twitter
+lists and StreamSource holds a filtered stream open instead, falling back
+to a ListSource while it is disconnected. ReplaySource and SyntheticSource
+stand in for both offline, so the pipeline can be load tested and
+production incidents replayed without touching the API.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from datetime import datetime
+from itertools import count
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Set
+
+import aiohttp
+import tweepy as tp
+
+from latency import tracker
+from store import Store
+from tweets import ListPool, PollScheduler, Tweet, TweetTimeline, get_list_timeline
+
+
+class TweetSource:
+    """Base class for the sources tweet_fetcher can poll"""
+
+    #: Seconds to wait before the next poll
+    interval: float = 1.0
+    #: Whether the source reads the list pool, so its members must be loaded
+    uses_lists: bool = False
+
+    async def poll(self) -> TweetTimeline:
+        """Return the tweets that arrived since the previous poll, in time order"""
+        raise NotImplementedError
+
+    def checkpoint(self) -> None:
+        """Persist whatever lets the source resume after a restart"""
+
+    async def track(self, screen_names: Iterable[str]) -> None:
+        """Follow exactly these accounts, for sources that have to be told"""
+
+    async def close(self) -> None:
+        """Release connections and background tasks"""
+
+    def stats(self) -> dict:
+        return {"source": type(self).__name__, "interval": self.interval}
+
+
+class ListSource(TweetSource):
+    """
+    Polls every list in a ListPool concurrently, keeping a since_id cursor per
+    list and pacing itself with a PollScheduler.
+    """
+
+    uses_lists = True
+
+    def __init__(
+        self,
+        api: tp.API,
+        lists: ListPool,
+        owner_id: int,
+        store: Store,
+        page_size: int = 200,
+        scheduler: PollScheduler = None,
+    ):
+        self.api = api
+        self.lists = lists
+        self.owner_id = owner_id
+        self.store = store
+        self.page_size = page_size
+        self.scheduler = scheduler or PollScheduler()
+        self.since_ids = self.load_cursors()
+        self._dirty = False
+        # Lists whose last poll failed, and whose cursors did not move
+        self.failed: List[int] = []
+
+    @property
+    def interval(self) -> float:
+        return self.scheduler.interval
+
+    def load_cursors(self) -> Dict[int, int]:
+        """Return the saved since_id of each list; lists without one start from their newest tweets"""
+        try:
+            return self.store.load_cursors()
+        except Exception as e:
+            logging.warning(f"Could not restore the timeline cursors: {e}")
+            return {}
+
+    def checkpoint(self) -> None:
+        """Queue since_ids for the store if they moved; it writes them out in the background"""
+        if not self._dirty:
+            return
+        self.store.save_cursors(self.since_ids)
+        self._dirty = False
+
+    def advance(self, since_id: int) -> None:
+        """Move every list's cursor up to `since_id`, e.g. once a stream has delivered everything before it"""
+        for list_id in self.lists.list_ids:
+            if since_id > self.since_ids.get(list_id, 0):
+                self.since_ids[list_id] = since_id
+                self._dirty = True
+
+    async def poll(self) -> TweetTimeline:
+        """
+        Poll every list at once and merge the results into one time-ordered
+        timeline, deduplicated by tweet id. If some lists fail, whatever the
+        error, the tweets from the others are still returned, only their
+        cursors advance, and the scheduler backs off.
+        """
+        list_ids = self.lists.list_ids
+        results = await asyncio.gather(
+            *(
+                get_list_timeline(
+                    list_id,
+                    self.owner_id,
+                    self.api,
+                    since_id=self.since_ids.get(list_id),
+                    page_size=self.page_size,
+                    scheduler=self.scheduler,
+                )
+                for list_id in list_ids
+            ),
+            return_exceptions=True,
+        )
+        fresh_tweets = TweetTimeline()
+        error = None
+        self.failed = [list_id for list_id, result in zip(list_ids, results) if isinstance(result, BaseException)]
+        for list_id, result in zip(list_ids, results):
+            if isinstance(result, (tp.TooManyRequests, tp.TwitterServerError, asyncio.TimeoutError)):
+                # Every list draws on the same quota, so running out of it outranks a server error
+                if error is None or isinstance(result, tp.TooManyRequests):
+                    error = result
+                continue
+            if isinstance(result, Exception):
+                # Anything else is this list's failure alone; its cursor stays put so the next poll retries it
+                logging.error(f"Polling list {list_id} failed", exc_info=result)
+                if error is None:
+                    error = result
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            if len(result) > 0:
+                self.since_ids[list_id] = max(tweet.id for tweet in result)
+                self._dirty = True
+                fresh_tweets.merge(result)
+
+        if isinstance(error, tp.TooManyRequests):
+            self.scheduler.observe(error.response)
+            delay = self.scheduler.record_failure(rate_limited=True)
+            logging.warning(f"Rate limited, next poll in {delay:.0f}s")
+        elif error is not None:
+            delay = self.scheduler.record_failure()
+            logging.warning(f"Error caught: {error!r}, next poll in {delay:.1f}s")
+        else:
+            self.scheduler.record_success(len(fresh_tweets))
+        return fresh_tweets
+
+    def stats(self) -> dict:
+        return {"source": type(self).__name__, "lists": len(self.lists.list_ids), **self.scheduler.stats()}
+
+
+# Filtered stream rules are tagged so rules added by anything else on the account are left alone
+STREAM_RULE_TAG = "twiscord"
+MAX_RULE_LENGTH = 512
+
+
+def pack_rules(screen_names: Iterable[str], max_length: int = MAX_RULE_LENGTH) -> List[str]:
+    """
+    Pack accounts into as few "from:a OR from:b" rules as fit in `max_length`.
+
+    Example:
+        >>> pack_rules(["a", "b", "c"], max_length=20)
+        ['from:a OR from:b', 'from:c']
+    """
+    rules, current = [], ""
+    for name in screen_names:
+        term = f"from:{name}"
+        if current and len(current) + len(" OR ") + len(term) > max_length:
+            rules.append(current)
+            current = ""
+        current = f"{current} OR {term}" if current else term
+    if current:
+        rules.append(current)
+    return rules
+
+
+def parse_rule(value: str) -> Set[str]:
+    """The accounts a rule built by pack_rules follows"""
+    return {term[len("from:") :].lower() for term in value.split(" OR ") if term.startswith("from:")}
+
+
+class StreamSource(TweetSource):
+    """
+    Reads tweets from a long-lived filtered stream (GET /2/tweets/search/stream)
+    on a background task, so they reach the fetcher without waiting for a poll.
+
+    The connection is reopened with jittered exponential backoff whenever it
+    drops or stalls. While it is down, and once more right after it comes back,
+    poll() defers to `backfill`, normally a ListSource whose cursors are kept
+    up to date from the stream, so nothing posted during the gap is lost.
+    """
+
+    uses_lists = True
+
+    def __init__(
+        self,
+        base_url: str,
+        bearer_token: str,
+        backfill: Optional[ListSource] = None,
+        interval: float = 0.1,
+        stall_timeout: float = 30.0,
+        max_backoff: float = 60.0,
+        checkpoint_every: float = 5.0,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {bearer_token}"}
+        self.backfill = backfill
+        self.stream_interval = interval
+        # Twitter sends a keep-alive newline every 20 seconds, so silence longer than this is a dead connection
+        self.stall_timeout = stall_timeout
+        self.max_backoff = max_backoff
+        self.checkpoint_every = checkpoint_every
+        self.rules: Dict[str, Set[str]] = {}
+        self.connected = False
+        self.reconnects = 0
+        self.received = 0
+        self.malformed = 0
+        self.last_id: Optional[int] = None
+        # The newest id seen before the connection dropped. Tweets posted in the gap have
+        # larger ids than this but may be smaller than ones the next connection delivers,
+        # so until the gap is backfilled the list cursors must not move past it.
+        self.gap_start: Optional[int] = None
+        # Backfill on startup too, to pick up what was posted while the bot was down
+        self.needs_backfill = backfill is not None
+        self._buffer: List[Tweet] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+        self._rules_loaded = False
+        self._checkpointed_at = 0.0
+
+    @property
+    def interval(self) -> float:
+        if self.backfill is not None and (self.needs_backfill or not self.connected):
+            return self.backfill.interval
+        return self.stream_interval
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(headers=self.headers)
+        return self._session
+
+    async def _load_rules(self) -> None:
+        if self._rules_loaded:
+            return
+        async with self._ensure_session().get(f"{self.base_url}/2/tweets/search/stream/rules") as resp:
+            resp.raise_for_status()
+            body = await resp.json()
+        self.rules = {
+            rule["id"]: parse_rule(rule["value"]) for rule in body.get("data") or () if rule.get("tag") == STREAM_RULE_TAG
+        }
+        self._rules_loaded = True
+
+    async def track(self, screen_names: Iterable[str]) -> None:
+        """
+        Update the stream rules to follow exactly `screen_names`. Rules that
+        only follow wanted accounts are kept; the others are replaced, and new
+        accounts are packed into fresh rules. Takes effect without reconnecting.
+        """
+        await self._load_rules()
+        wanted = {name.lower() for name in screen_names}
+        stale = [rule_id for rule_id, names in self.rules.items() if not names <= wanted]
+        covered = set().union(*(names for rule_id, names in self.rules.items() if rule_id not in stale))
+        additions = pack_rules(sorted(wanted - covered))
+        url = f"{self.base_url}/2/tweets/search/stream/rules"
+        session = self._ensure_session()
+        if stale:
+            async with session.post(url, json={"delete": {"ids": stale}}) as resp:
+                resp.raise_for_status()
+            for rule_id in stale:
+                del self.rules[rule_id]
+        if additions:
+            payload = {"add": [{"value": value, "tag": STREAM_RULE_TAG} for value in additions]}
+            async with session.post(url, json=payload) as resp:
+                resp.raise_for_status()
+                body = await resp.json()
+            for rule in body.get("data") or ():
+                self.rules[rule["id"]] = parse_rule(rule["value"])
+
+    async def _run(self) -> None:
+        url = f"{self.base_url}/2/tweets/search/stream"
+        params = {"expansions": "author_id", "tweet.fields": "created_at", "user.fields": "username"}
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self.stall_timeout)
+        backoff = min(1.0, self.max_backoff)
+        while True:
+            try:
+                async with self._ensure_session().get(url, params=params, timeout=timeout) as resp:
+                    resp.raise_for_status()
+                    self.connected = True
+                    backoff = min(1.0, self.max_backoff)
+                    async for line in resp.content:
+                        # Blank lines are keep-alives
+                        if not line.strip():
+                            continue
+                        try:
+                            self._receive(json.loads(line))
+                        except Exception:
+                            # One bad message must not take the stream down with it
+                            logging.exception(f"Skipping malformed stream message: {line[:200]!r}")
+                            self.malformed += 1
+                logging.warning("Tweet stream closed by the server")
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f"Tweet stream dropped: {e!r}")
+            except Exception:
+                logging.exception("Tweet stream failed")
+            finally:
+                # However the connection ended, poll() has to backfill what it missed
+                if self.connected:
+                    self.connected = False
+                    if self.backfill is not None and not self.needs_backfill:
+                        # An earlier gap still waiting for backfill starts further back, so it wins
+                        self.gap_start = self.last_id
+                    self.needs_backfill = self.backfill is not None
+                    self.reconnects += 1
+            await asyncio.sleep(random.uniform(backoff / 2, backoff))
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _receive(self, message: dict) -> None:
+        data = message.get("data")
+        if not data:
+            # Errors and operational messages carry no tweet
+            return
+        users = {user["id"]: user["username"] for user in message.get("includes", {}).get("users", ())}
+        created_at = datetime.fromisoformat(data["created_at"].replace("Z", "+00:00")).timestamp()
+        screen_name = users.get(data["author_id"], data["author_id"]).strip().lower()
+        tweet = Tweet(created_at, screen_name, int(data["id"]), data["text"])
+        tracker.fetched((tweet,))
+        self._buffer.append(tweet)
+        self.received += 1
+        self.last_id = max(self.last_id or 0, tweet.id)
+
+    async def poll(self) -> TweetTimeline:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        fresh_tweets = TweetTimeline(self._buffer)
+        self._buffer = []
+        if self.backfill is not None and (self.needs_backfill or not self.connected):
+            if self.gap_start is not None:
+                self.backfill.advance(self.gap_start)
+            # Keep backfilling while disconnected; once connected, this poll closes the gap
+            closing = self.connected
+            fresh_tweets.merge(await self.backfill.poll())
+            # A drop during the poll reopened the gap, and a list that failed has not caught up yet
+            if closing and self.connected and not self.backfill.failed:
+                self.needs_backfill = False
+                self.gap_start = None
+        return fresh_tweets
+
+    def checkpoint(self) -> None:
+        if self.backfill is None or time.time() - self._checkpointed_at < self.checkpoint_every:
+            return
+        # Until the gap is backfilled, the stream's newest id is past tweets the lists still have to return
+        cursor = self.gap_start if self.needs_backfill else self.last_id
+        if cursor is not None:
+            self.backfill.advance(cursor)
+        self.backfill.checkpoint()
+        self._checkpointed_at = time.time()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._session is not None:
+            await self._session.close()
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            "received": self.received,
+            "malformed": self.malformed,
+            "rules": len(self.rules),
+            "backfilling": self.needs_backfill,
+        }
+
+
+def write_jsonl(tweets: Iterable[Tweet], fp: IO[str]) -> None:
+    """Append tweets to a recording that ReplaySource can play back"""
+    for tweet in tweets:
+        record = {"timestamp": tweet.timestamp, "screen_name": tweet.screen_name, "id": tweet.id, "text": tweet.text}
+        fp.write(json.dumps(record) + "\n")
+
+
+def read_jsonl(fp: IO[str]) -> Iterator[Tweet]:
+    """Read back the tweets written by write_jsonl, skipping blank lines"""
+    for line in fp:
+        if line.strip():
+            record = json.loads(line)
+            yield Tweet(record["timestamp"], record["screen_name"], record["id"], record["text"])
+
+
+class ReplaySource(TweetSource):
+    """
+    Plays back a JSONL recording made with write_jsonl, either at the pace the
+    tweets were originally posted (speed=1) or `speed` times faster. Tweets are
+    restamped as if they were being posted now, so the fetcher treats them as
+    new. The recording is read lazily and the source runs dry at its end.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, interval: float = 0.1):
+        self.path = path
+        self.speed = speed
+        self.interval = interval
+        self._file = open(path)
+        self._records = read_jsonl(self._file)
+        self._next: Optional[Tweet] = next(self._records, None)
+        self._start = None
+        self._first = None
+        self.replayed = 0
+
+    async def poll(self) -> TweetTimeline:
+        now = time.time()
+        if self._start is None and self._next is not None:
+            self._start, self._first = now, self._next.timestamp
+        fresh_tweets = TweetTimeline()
+        while self._next is not None:
+            stamp = self._start + (self._next.timestamp - self._first) / self.speed
+            if stamp > now:
+                break
+            tweet = self._next
+            fresh_tweets.add(Tweet(stamp, tweet.screen_name, tweet.id, tweet.text))
+            self._next = next(self._records, None)
+        self.replayed += len(fresh_tweets)
+        if self._next is None and not self._file.closed:
+            self._file.close()
+        return fresh_tweets
+
+    def stats(self) -> dict:
+        return {**super().stats(), "path": self.path, "speed": self.speed, "replayed": self.replayed, "done": self._next is None}
+
+
+class SyntheticSource(TweetSource):
+    """
+    Generates `rate` tweets per second spread round robin across `handles`
+    accounts named synthetic0, synthetic1, ... Each tweet is stamped with the
+    moment it was due, so end-to-end latency can be read off the timestamps.
+    """
+
+    def __init__(self, rate: float = 100.0, handles: int = 1000, text_length: int = 140, interval: float = 0.1):
+        self.rate = rate
+        self.handles = [f"synthetic{i}" for i in range(handles)]
+        self.text = "x" * text_length
+        self.interval = interval
+        # Ids only need to be unique and increasing, like real tweet ids
+        self._ids = count(int(time.time() * 1000) << 22)
+        self._last = None
+        self.generated = 0
+
+    async def poll(self) -> TweetTimeline:
+        now = time.time()
+        if self._last is None:
+            self._last = now
+        due = int((now - self._last) * self.rate)
+        fresh_tweets = TweetTimeline()
+        for i in range(due):
+            tweet_id = next(self._ids)
+            fresh_tweets.add(Tweet(self._last + (i + 1) / self.rate, self.handles[tweet_id % len(self.handles)], tweet_id, self.text))
+        # Carry the fraction of a tweet that was not due yet over to the next poll
+        self._last += due / self.rate
+        self.generated += due
+        return fresh_tweets
+
+    def stats(self) -> dict:
+        return {**super().stats(), "rate": self.rate, "handles": len(self.handles), "generated": self.generated}
@@ -0,0 +1,267 @@
+"""
+Durable bot state in a single SQLite database.
+
+Subscriptions, the tracked accounts and which list each one is on, the
+timeline cursors and recently delivered tweets used to live only in memory
+(or in a couple of ad hoc files) and were rebuilt from the Twitter API on
+every restart. The Store keeps them in SQLite in WAL mode instead.
+
+Reads are served from memory: each cog keeps its in-memory structures and
+only loads them from the Store once, at startup, with one query per table.
+Writes are write-behind: mutations are queued in memory, coalesced by key,
+and committed in one transaction by a background thread every
+`flush_interval` seconds, or sooner once `max_pending` have built up. A crash
+loses at most the last interval of changes.
+"""
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from subscriptions import SubscriptionIndex
+from tweets import Tweet
+
+STORE_PATH = os.environ.get("STORE_PATH", "twiscord.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    scope TEXT NOT NULL,
+    account TEXT NOT NULL,
+    subscriber NOT NULL,
+    PRIMARY KEY (scope, account, subscriber)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS list_members (account TEXT PRIMARY KEY, list_id INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cursors (list_id INTEGER PRIMARY KEY, since_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS tweets (id INTEGER PRIMARY KEY, timestamp REAL NOT NULL, screen_name TEXT NOT NULL, text TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID;
+"""
+
+# Columns of each table, and how many of the leading ones make up its primary key
+_COLUMNS = {
+    "subscriptions": (("scope", "account", "subscriber"), 3),
+    "list_members": (("account", "list_id"), 1),
+    "cursors": (("list_id", "since_id"), 1),
+    "tweets": (("id", "timestamp", "screen_name", "text"), 1),
+    "blobs": (("name", "data"), 1),
+}
+
+
+class Store:
+    """
+    Write-behind SQLite storage for the bot's state. Safe to use from any
+    thread; the database is only touched by one of them at a time.
+
+    Keeps the newest `history_size` delivered tweets.
+    """
+
+    def __init__(self, path: str = STORE_PATH, flush_interval: float = 1.0, max_pending: int = 1000, history_size: int = 200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.history_size = history_size
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL only skips the fsync on commit, which a crash of the bot process cannot lose
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        # (table, primary key) -> row to write, or None to delete
+        self._pending: Dict[Tuple[str, tuple], Optional[tuple]] = {}
+        self._lock = threading.Lock()
+        # Held for a whole flush so batches are committed in the order they were queued
+        self._flush_lock = threading.RLock()
+        self._wake = threading.Event()
+        self._closed = False
+        self.flushes = 0
+        self.written = 0
+        self.last_flush_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, name="store-writer", daemon=True)
+        self._thread.start()
+
+    def _queue(self, table: str, key: tuple, row: Optional[tuple]) -> None:
+        with self._lock:
+            self._pending[table, key] = row
+            backlog = len(self._pending)
+        if backlog >= self.max_pending:
+            self._wake.set()
+
+    def _put(self, table: str, row: tuple) -> None:
+        self._queue(table, row[: _COLUMNS[table][1]], row)
+
+    def _delete(self, table: str, key: tuple) -> None:
+        self._queue(table, key, None)
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Commit every queued change in one transaction; returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            puts, deletes = defaultdict(list), defaultdict(list)
+            for (table, key), row in pending.items():
+                if row is None:
+                    deletes[table].append(key)
+                else:
+                    puts[table].append(row)
+
+            started = time.perf_counter()
+            try:
+                with self._db:
+                    for table, keys in deletes.items():
+                        columns, key_length = _COLUMNS[table]
+                        where = " AND ".join(f"{column} = ?" for column in columns[:key_length])
+                        self._db.executemany(f"DELETE FROM {table} WHERE {where}", keys)
+                    for table, rows in puts.items():
+                        placeholders = ", ".join("?" * len(_COLUMNS[table][0]))
+                        self._db.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", rows)
+                    if "tweets" in puts:
+                        self._db.execute(
+                            "DELETE FROM tweets WHERE id NOT IN "
+                            "(SELECT id FROM tweets ORDER BY timestamp DESC, id DESC LIMIT ?)",
+                            (self.history_size,),
+                        )
+            except sqlite3.Error:
+                logging.exception(f"Could not write {len(pending)} changes to {self.path}, will retry")
+                with self._lock:
+                    # Anything queued since is newer and wins
+                    for key, row in pending.items():
+                        self._pending.setdefault(key, row)
+                return 0
+
+            self.last_flush_seconds = time.perf_counter() - started
+            self.flushes += 1
+            self.written += len(pending)
+            return len(pending)
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        # Flushing first means a read always sees every write queued before it
+        with self._flush_lock:
+            self.flush()
+            return self._db.execute(sql, params).fetchall()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        self._db.close()
+
+    # Subscriptions
+
+    def subscriptions(self, scope: str) -> "StoredSubscriptionIndex":
+        """Load the subscriptions saved under `scope` into an index that saves its own changes"""
+        return StoredSubscriptionIndex(self, scope)
+
+    def load_subscriptions(self, scope: str) -> List[Tuple[str, Hashable]]:
+        return self._query("SELECT account, subscriber FROM subscriptions WHERE scope = ?", (scope,))
+
+    def subscribe(self, scope: str, account: str, subscriber: Hashable) -> None:
+        self._put("subscriptions", (scope, account, subscriber))
+
+    def unsubscribe(self, scope: str, account: str, subscriber: Hashable) -> None:
+        self._delete("subscriptions", (scope, account, subscriber))
+
+    # Tracked accounts
+
+    def load_list_members(self) -> Dict[int, List[str]]:
+        """The accounts on each list, as last saved"""
+        members = defaultdict(list)
+        for account, list_id in self._query("SELECT account, list_id FROM list_members"):
+            members[list_id].append(account)
+        return dict(members)
+
+    def set_list_member(self, account: str, list_id: Optional[int]) -> None:
+        """Record which list `account` is on, or with None that it is on none"""
+        if list_id is None:
+            self._delete("list_members", (account,))
+        else:
+            self._put("list_members", (account, list_id))
+
+    # Timeline cursors
+
+    def load_cursors(self) -> Dict[int, int]:
+        return dict(self._query("SELECT list_id, since_id FROM cursors"))
+
+    def save_cursors(self, since_ids: Dict[int, int]) -> None:
+        for list_id, since_id in since_ids.items():
+            self._put("cursors", (list_id, since_id))
+
+    # Delivered tweets
+
+    def record_tweets(self, tweets: Iterable[Tweet]) -> None:
+        for tweet in tweets:
+            self._put("tweets", (tweet.id, tweet.timestamp, tweet.screen_name, tweet.text))
+
+    def load_tweets(self) -> List[Tweet]:
+        """The most recently delivered tweets, oldest first"""
+        rows = self._query("SELECT timestamp, screen_name, id, text FROM tweets ORDER BY timestamp, id")
+        return [Tweet(*row) for row in rows]
+
+    # Anything else, saved whole
+
+    def save_blob(self, name: str, data: bytes) -> None:
+        self._put("blobs", (name, data))
+
+    def load_blob(self, name: str) -> Optional[bytes]:
+        rows = self._query("SELECT data FROM blobs WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "flushes": self.flushes,
+            "written": self.written,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+
+class StoredSubscriptionIndex(SubscriptionIndex):
+    """A SubscriptionIndex loaded from a Store, which queues every change it makes back to it"""
+
+    def __init__(self, store: Store, scope: str):
+        super().__init__()
+        self.store = store
+        self.scope = scope
+        for account, subscriber in store.load_subscriptions(scope):
+            super().add(account, subscriber)
+
+    def add(self, account: str, subscriber: Hashable) -> bool:
+        if not super().add(account, subscriber):
+            return False
+        self.store.subscribe(self.scope, account, subscriber)
+        return True
+
+    def remove(self, account: str, subscriber: Hashable) -> bool:
+        if not super().remove(account, subscriber):
+            return False
+        self.store.unsubscribe(self.scope, account, subscriber)
+        return True
+
+
+_shared_store: Optional[Store] = None
+_shared_lock = threading.Lock()
+
+
+def shared_store() -> Store:
+    """The Store shared by everything in this process, opened on first use and flushed at exit"""
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = Store()
+            atexit.register(_shared_store.close)
+        return _shared_store
@@ -0,0 +1,126 @@
+"""
+Who is subscribed to which Twitter account.
+
+Both cogs keep one of these: Tweets maps accounts to Discord channel ids and
+Texts maps them to phone numbers. The index is kept in both directions, so
+"who gets this account's tweets" and "what does this channel follow" are
+each a single lookup instead of a scan over every account.
+"""
+from typing import Dict, FrozenSet, Hashable, Iterator, List, Optional, Set
+
+
+class SubscriptionIndex:
+    """
+    A bidirectional many-to-many map of account -> subscribers and
+    subscriber -> accounts.
+
+    Accounts are interned to small integers internally, so each subscription
+    costs an int in two sets rather than another reference to a string, and
+    ids are reused once an account loses its last subscriber.
+
+    Example:
+        >>> index = SubscriptionIndex()
+        >>> index.add("nasa", 1), index.add("nasa", 2), index.add("esa", 1), index.add("nasa", 1)
+        (True, True, True, False)
+        >>> sorted(index.subscribers("nasa")), sorted(index.accounts(1))
+        ([1, 2], ['esa', 'nasa'])
+        >>> index.remove("esa", 1), "esa" in index, len(index)
+        (True, False, 1)
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._names: List[Optional[str]] = []
+        self._free: List[int] = []
+        self._subscribers: Dict[int, Set[Hashable]] = {}
+        self._accounts: Dict[Hashable, Set[int]] = {}
+        self._count = 0
+
+    def _intern(self, account: str) -> int:
+        account_id = self._ids.get(account)
+        if account_id is None:
+            if self._free:
+                account_id = self._free.pop()
+                self._names[account_id] = account
+            else:
+                account_id = len(self._names)
+                self._names.append(account)
+            self._ids[account] = account_id
+        return account_id
+
+    def _release(self, account_id: int) -> None:
+        del self._ids[self._names[account_id]]
+        self._names[account_id] = None
+        self._free.append(account_id)
+
+    def add(self, account: str, subscriber: Hashable) -> bool:
+        """Subscribe; returns False if the subscription already existed"""
+        account_id = self._intern(account)
+        subscribers = self._subscribers.setdefault(account_id, set())
+        if subscriber in subscribers:
+            return False
+        subscribers.add(subscriber)
+        self._accounts.setdefault(subscriber, set()).add(account_id)
+        self._count += 1
+        return True
+
+    def remove(self, account: str, subscriber: Hashable) -> bool:
+        """Unsubscribe; returns False if there was no such subscription"""
+        account_id = self._ids.get(account)
+        subscribers = self._subscribers.get(account_id)
+        if subscribers is None or subscriber not in subscribers:
+            return False
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[account_id]
+            self._release(account_id)
+        accounts = self._accounts[subscriber]
+        accounts.discard(account_id)
+        if not accounts:
+            del self._accounts[subscriber]
+        self._count -= 1
+        return True
+
+    def remove_account(self, account: str) -> FrozenSet[Hashable]:
+        """Drop every subscription to `account`; returns who was subscribed"""
+        subscribers = self.subscribers(account)
+        for subscriber in subscribers:
+            self.remove(account, subscriber)
+        return subscribers
+
+    def remove_subscriber(self, subscriber: Hashable) -> List[str]:
+        """Drop every subscription `subscriber` has; returns the accounts it followed"""
+        accounts = self.accounts(subscriber)
+        for account in accounts:
+            self.remove(account, subscriber)
+        return accounts
+
+    def subscribers(self, account: str) -> FrozenSet[Hashable]:
+        """Everyone subscribed to `account`"""
+        return frozenset(self._subscribers.get(self._ids.get(account), ()))
+
+    def accounts(self, subscriber: Hashable) -> List[str]:
+        """Every account `subscriber` is subscribed to"""
+        return [self._names[account_id] for account_id in self._accounts.get(subscriber, ())]
+
+    def is_subscribed(self, account: str, subscriber: Hashable) -> bool:
+        return subscriber in self._subscribers.get(self._ids.get(account), ())
+
+    def all_subscribers(self) -> List[Hashable]:
+        """Everyone with at least one subscription"""
+        return list(self._accounts)
+
+    @property
+    def subscription_count(self) -> int:
+        return self._count
+
+    def __contains__(self, account: str) -> bool:
+        """Whether anyone is subscribed to `account`"""
+        return account in self._ids
+
+    def __iter__(self) -> Iterator[str]:
+        """The accounts with at least one subscriber"""
+        return iter(list(self._ids))
+
+    def __len__(self) -> int:
+        return len(self._ids)
@@ -0,0 +1,90 @@
+"""
+TweetDedup deciding which tweets are new: same-second bursts, tweets that
+arrive out of order, the count and age bounds, and the Bloom filter variant.
+"""
+import pytest
+
+import dedup
+from dedup import CountingBloomFilter, TweetDedup
+from tweets import Tweet
+
+VARIANTS = [{}, {"bloom_error": 0.01}]
+
+
+def tweets(*ids, timestamp=100.0):
+    return [Tweet(timestamp, "someone", tweet_id, "") for tweet_id in ids]
+
+
+@pytest.mark.parametrize("options", VARIANTS)
+def test_same_second_burst_is_all_new(options):
+    seen = TweetDedup(maxlen=1000, **options)
+    assert [tweet.id for tweet in seen.filter(tweets(11, 12, 13))] == [11, 12, 13]
+    assert [tweet.id for tweet in seen.filter(tweets(11, 12, 13, 14))] == [14]
+
+
+@pytest.mark.parametrize("options", VARIANTS)
+def test_out_of_order_tweets_are_new_and_repeats_are_not(options):
+    seen = TweetDedup(maxlen=1000, **options)
+    seen.filter(tweets(11, 12, 13))
+    late = tweets(12) + tweets(10, 10, timestamp=99.0)
+    assert [tweet.id for tweet in seen.filter(late)] == [10]
+    assert seen.add(12) is False and seen.add(14) is True
+    assert seen.stats() == {"ids": 5, "duplicates": 3, "bloom": "bloom_error" in options}
+
+
+@pytest.mark.parametrize("options", VARIANTS)
+def test_maxlen_forgets_the_oldest_ids(options):
+    seen = TweetDedup(maxlen=3, **options)
+    seen.filter(tweets(11, 12, 13))
+    assert [tweet.id for tweet in seen.filter(tweets(12, 10, 10))] == [10]
+    assert 11 not in seen and 10 in seen
+    assert len(seen) == 3
+    # Forgotten ids count as new again, pushing out the next oldest
+    assert seen.add(11) is True
+    assert len(seen) == 3 and 13 in seen and 10 in seen
+
+
+@pytest.mark.parametrize("options", VARIANTS)
+def test_max_age_expires_old_ids(options, monkeypatch):
+    seen = TweetDedup(maxlen=1000, max_age=10.0, **options)
+    assert seen.add(1, now=0.0) and seen.add(2, now=5.0)
+    assert seen.add(1, now=9.0) is False
+    # 1 was seen at 0.0 and is past max_age at 10.5; 2 is not
+    assert seen.add(1, now=10.5) is True
+    assert seen.add(2, now=10.5) is False
+    assert len(seen) == 2
+    monkeypatch.setattr(dedup.time, "monotonic", lambda: 15.5)
+    assert 2 not in seen and 1 in seen
+    assert len(seen) == 1
+    monkeypatch.setattr(dedup.time, "monotonic", lambda: 100.0)
+    assert 1 not in seen and len(seen) == 0
+    assert [tweet.id for tweet in seen.filter(tweets(1, 2))] == [1, 2]
+
+
+def test_without_max_age_ids_never_expire(monkeypatch):
+    seen = TweetDedup(maxlen=10)
+    seen.add(1, now=0.0)
+    monkeypatch.setattr(dedup.time, "monotonic", lambda: 1e9)
+    assert 1 in seen and seen.add(1) is False
+
+
+def test_bloom_filter_false_positive_rate_is_near_its_target():
+    bloom = CountingBloomFilter(capacity=10_000, error_rate=0.01)
+    for item in range(10_000):
+        bloom.add(item)
+    assert all(item in bloom for item in range(10_000))
+    false_positives = sum(item in bloom for item in range(10**9, 10**9 + 100_000))
+    assert false_positives / 100_000 < 0.02
+
+
+def test_bloom_filter_removal_only_forgets_what_was_removed():
+    bloom = CountingBloomFilter(capacity=100, error_rate=0.001)
+    for item in range(50):
+        bloom.add(item)
+    bloom.add(7)
+    bloom.remove(7)
+    assert 7 in bloom
+    for item in range(25):
+        bloom.remove(item)
+    assert sum(item in bloom for item in range(25)) <= 1
+    assert all(item in bloom for item in range(25, 50))
@@ -0,0 +1,164 @@
+"""
+OrderedDequeSet checked against a plain list as the reference model.
+
+Random sequences of operations are applied to both, and after every step the
+set must agree with the model on order, membership, indexing and evictions,
+and its index must match its deque. Run with `python -m pytest tests` from
+the repository root.
+"""
+import pickle
+import random
+
+import pytest
+
+from dequeset import _TOMBSTONE, OrderedDequeSet
+
+
+class Model:
+    """What an OrderedDequeSet should contain, as a list, and what it should have evicted"""
+
+    def __init__(self, maxlen=None):
+        self.items = []
+        self.maxlen = maxlen
+        self.evicted = []
+
+    def add(self, key):
+        if key in self.items:
+            return self.items.index(key)
+        self.items.append(key)
+        if self.maxlen is not None and len(self.items) > self.maxlen:
+            self.evicted.append(self.items.pop(0))
+        return len(self.items) - 1
+
+    def addleft(self, key):
+        if key in self.items:
+            return self.items.index(key)
+        self.items.insert(0, key)
+        if self.maxlen is not None and len(self.items) > self.maxlen:
+            self.evicted.append(self.items.pop())
+        return 0
+
+    def merge(self, keys):
+        fresh = [key for key in dict.fromkeys(keys) if key not in self.items]
+        self.items.extend(fresh)
+        if self.maxlen is not None and len(self.items) > self.maxlen:
+            overflow = len(self.items) - self.maxlen
+            existing = len(self.items) - len(fresh)
+            # Items that would be pushed straight back out are neither inserted nor evicted
+            self.evicted.extend(self.items[: min(overflow, existing)])
+            del self.items[:overflow]
+            fresh = [key for key in fresh if key in self.items]
+        return fresh
+
+    def set_maxlen(self, value):
+        self.maxlen = value
+        while len(self.items) > value:
+            self.evicted.append(self.items.pop(0))
+
+
+def check(oset, model):
+    assert list(oset) == model.items
+    assert list(reversed(oset)) == model.items[::-1]
+    assert len(oset) == len(model.items)
+    assert oset.snapshot() == tuple(model.items)
+    for i, item in enumerate(model.items):
+        assert oset[i] == item
+        assert oset[i - len(model.items)] == item
+        assert oset.index(item) == i
+        assert item in oset
+    # The index holds exactly the live items, at the deque slots they occupy
+    assert set(oset.map) == set(model.items)
+    for item, pos in oset.map.items():
+        assert oset.items[pos - oset._base] == item
+    holes = [i + oset._base for i, item in enumerate(oset.items) if item is _TOMBSTONE]
+    assert holes == oset._holes
+    if oset.items:
+        assert oset.items[0] is not _TOMBSTONE and oset.items[-1] is not _TOMBSTONE
+    if oset.maxlen is not None:
+        assert len(oset.items) <= oset.maxlen
+
+
+def step(rng, oset, model, universe):
+    op = rng.choice(["add", "add", "add", "addleft", "merge", "discard", "discard", "pop", "popleft", "maxlen"])
+    if op == "add":
+        key = rng.randrange(universe)
+        assert oset.add(key) == model.add(key)
+    elif op == "addleft":
+        key = rng.randrange(universe)
+        assert oset.addleft(key) == model.addleft(key)
+    elif op == "merge":
+        keys = [rng.randrange(universe) for _ in range(rng.randrange(8))]
+        assert oset.merge(keys) == model.merge(keys)
+    elif op == "discard":
+        key = rng.randrange(universe)
+        oset.discard(key)
+        if key in model.items:
+            model.items.remove(key)
+    elif op == "pop" and model.items:
+        index = rng.randrange(-len(model.items), len(model.items))
+        assert oset.pop(index) == model.items.pop(index)
+    elif op == "popleft" and model.items:
+        assert oset.popleft() == model.items.pop(0)
+    elif op == "maxlen" and oset.maxlen is not None:
+        value = rng.randrange(1, 2 * oset.maxlen + 2)
+        oset.maxlen = value
+        model.set_maxlen(value)
+
+
+@pytest.mark.parametrize("seed", range(40))
+@pytest.mark.parametrize("maxlen", [None, 1, 5, 20])
+def test_matches_reference_model(seed, maxlen):
+    rng = random.Random(seed)
+    model = Model(maxlen)
+    evicted = []
+    oset = OrderedDequeSet(maxlen=maxlen, on_evict=evicted.append)
+    for _ in range(300):
+        step(rng, oset, model, universe=30)
+        check(oset, model)
+    assert evicted == model.evicted
+
+
+def test_shrinking_maxlen_with_tombstones_evicts_through_the_index():
+    evicted = []
+    oset = OrderedDequeSet([1, 2, 3, 4, 5, 6], maxlen=10, on_evict=evicted.append)
+    oset.discard(3)
+    oset.maxlen = 3
+    assert list(oset) == [4, 5, 6]
+    assert evicted == [1, 2]
+    assert 1 not in oset and 2 not in oset
+    assert sorted(oset.map) == [4, 5, 6]
+    assert [oset.index(item) for item in (4, 5, 6)] == [0, 1, 2]
+
+
+def test_evicted_items_leave_the_index():
+    oset = OrderedDequeSet(maxlen=3)
+    for item in range(1000):
+        oset.add(item)
+    assert list(oset) == [997, 998, 999]
+    assert len(oset.map) == 3
+    assert 0 not in oset
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_round_trips_keep_order_and_maxlen(seed):
+    rng = random.Random(seed)
+    model = Model(maxlen=8)
+    oset = OrderedDequeSet(maxlen=8)
+    for _ in range(100):
+        step(rng, oset, model, universe=20)
+    for copy in (pickle.loads(pickle.dumps(oset)), OrderedDequeSet.from_bytes(oset.to_bytes()), oset.copy()):
+        assert list(copy) == model.items
+        assert copy.maxlen == oset.maxlen
+
+
+def test_failed_merge_leaves_the_set_untouched():
+    oset = OrderedDequeSet([1])
+    with pytest.raises(TypeError):
+        oset.merge([2, [3]])
+    with pytest.raises(TypeError):
+        oset |= [4, {}]
+    assert list(oset) == [1]
+    assert 2 not in oset and 4 not in oset
+    assert oset.map == {1: 0}
+    with pytest.raises(ValueError):
+        oset.merge(5)
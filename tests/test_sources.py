@@ -0,0 +1,117 @@
+"""
+StreamSource against a local stand-in for Twitter's filtered stream, with a
+ListSource backfill whose timelines are served from memory.
+"""
+import asyncio
+import json
+
+from aiohttp import web
+
+import sources
+from sources import ListSource, StreamSource
+from store import Store
+from tweets import ListPool, Tweet, TweetTimeline
+
+LIST_ID = 1
+
+
+def message(tweet_id):
+    return json.dumps(
+        {
+            "data": {"id": str(tweet_id), "author_id": "7", "text": f"tweet {tweet_id}", "created_at": "2022-01-01T00:00:00Z"},
+            "includes": {"users": [{"id": "7", "username": "Someone"}]},
+        }
+    ).encode() + b"\n"
+
+
+class StandIn:
+    """
+    The first connection delivers 99 and 100, then drops once told to; 101 to
+    105 are posted while it is down. The second connection delivers 106.
+    Every tweet is also on the list timeline from the moment it is posted.
+    """
+
+    def __init__(self):
+        self.timeline = []
+        self.connections = 0
+        self.first_sent = asyncio.Event()
+        self.drop = asyncio.Event()
+        self.reconnected = asyncio.Event()
+        self.finished = asyncio.Event()
+
+    async def stream(self, request):
+        self.connections += 1
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        if self.connections == 1:
+            for tweet_id in (99, 100):
+                self.timeline.append(tweet_id)
+                await resp.write(message(tweet_id))
+            self.first_sent.set()
+            await self.drop.wait()
+            self.timeline.extend(range(101, 106))
+            return resp
+        self.timeline.append(106)
+        await resp.write(message(106))
+        self.reconnected.set()
+        await self.finished.wait()
+        return resp
+
+    async def list_timeline(self, list_id, owner_id, api, since_id=None, page_size=20, scheduler=None):
+        return TweetTimeline(Tweet(float(i), "someone", i, f"tweet {i}") for i in self.timeline if since_id is None or i > since_id)
+
+
+async def wait_for(condition, timeout=5.0):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_reconnect_backfills_the_gap(tmp_path, monkeypatch):
+    async def main():
+        stand_in = StandIn()
+        monkeypatch.setattr(sources, "get_list_timeline", stand_in.list_timeline)
+        app = web.Application()
+        app.router.add_get("/2/tweets/search/stream", stand_in.stream)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        store = Store(str(tmp_path / "state.db"))
+        backfill = ListSource(None, ListPool([LIST_ID]), 0, store)
+        backfill.since_ids = {LIST_ID: 98}
+        source = StreamSource(f"http://127.0.0.1:{port}", "token", backfill=backfill, max_backoff=0.05, checkpoint_every=0)
+        seen = []
+        try:
+            seen += [tweet.id for tweet in await source.poll()]
+            # Once connected, a poll finishes the startup backfill
+            await asyncio.wait_for(stand_in.first_sent.wait(), 5)
+            await wait_for(lambda: source.connected)
+            seen += [tweet.id for tweet in await source.poll()]
+            assert not source.needs_backfill
+
+            stand_in.drop.set()
+            await asyncio.wait_for(stand_in.reconnected.wait(), 5)
+            await wait_for(lambda: source.connected and source.last_id == 106)
+            assert source.needs_backfill and source.gap_start == 100
+
+            # A checkpoint before the gap is backfilled must not skip past it
+            source.checkpoint()
+            assert backfill.since_ids[LIST_ID] == 100
+
+            seen += [tweet.id for tweet in await source.poll()]
+            assert set(range(99, 107)) <= set(seen)
+            assert not source.needs_backfill and source.gap_start is None
+            assert backfill.since_ids[LIST_ID] == 106
+            assert source.reconnects == 1
+        finally:
+            stand_in.finished.set()
+            await source.close()
+            await runner.cleanup()
+            store.close()
+
+    asyncio.run(main())
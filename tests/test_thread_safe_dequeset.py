@@ -0,0 +1,183 @@
+"""
+Stress test for ThreadSafeOrderedDequeSet: worker threads and coroutines on
+the event loop write to one set while others read it, and afterwards every
+item is accounted for and the index still matches the deque. Also covers
+publishing snapshots and waking coroutines through AsyncDequeSetView.
+"""
+import asyncio
+import random
+import sys
+import threading
+from collections import deque
+
+import pytest
+
+from dequeset import _TOMBSTONE, AsyncDequeSetView, ThreadSafeOrderedDequeSet
+
+MAXLEN = 64
+WRITES = 3000
+
+
+def check_invariants(oset):
+    with oset._lock:
+        live = [item for item in oset.items if item is not _TOMBSTONE]
+        assert len(live) == len(set(live)) == len(oset)
+        assert set(oset.map) == set(live)
+        for item, pos in oset.map.items():
+            assert oset.items[pos - oset._base] == item
+        assert oset._holes == [i + oset._base for i, item in enumerate(oset.items) if item is _TOMBSTONE]
+        assert len(oset.items) <= MAXLEN
+        assert list(oset) == live
+        assert oset._seq % 2 == 0
+
+
+def check_snapshot(view):
+    assert _TOMBSTONE not in view
+    assert len(view) == len(set(view)) <= MAXLEN
+
+
+@pytest.fixture
+def fast_switching():
+    # Switch threads far more often than the default 5ms, so writes and reads interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def test_concurrent_writers_and_readers_keep_the_set_consistent(fast_switching):
+    evicted = []
+    oset = ThreadSafeOrderedDequeSet(maxlen=MAXLEN, on_evict=evicted.append)
+    added, removed = [], []
+    errors = []
+    done = threading.Event()
+
+    def writer(worker):
+        rng = random.Random(worker)
+        mine, gone = [], []
+        try:
+            for n in range(WRITES):
+                op = rng.random()
+                if op < 0.6:
+                    key = (worker, n)
+                    oset.add(key)
+                    mine.append(key)
+                elif op < 0.75:
+                    keys = [(worker, n, i) for i in range(rng.randrange(1, 6))]
+                    # Items pushed straight back out by maxlen are never inserted
+                    mine.extend(oset.merge(keys))
+                elif op < 0.95 and mine:
+                    key = rng.choice(mine)
+                    if key in oset:
+                        oset.discard(key)
+                        if key not in oset:
+                            gone.append(key)
+                elif rng.random() < 0.1:
+                    oset.maxlen = MAXLEN
+        except Exception as e:
+            errors.append(e)
+        added.extend(mine)
+        removed.extend(gone)
+
+    def reader():
+        try:
+            while not done.is_set():
+                view = oset.snapshot()
+                check_snapshot(view)
+                check_snapshot(tuple(oset))
+                if view:
+                    try:
+                        oset.index(view[-1])
+                    except KeyError:
+                        pass  # removed since the snapshot was taken
+                    assert len(oset) <= MAXLEN
+        except Exception as e:
+            errors.append(e)
+
+    async def loop_writer():
+        for n in range(WRITES):
+            key = ("loop", n)
+            oset.add(key)
+            added.append(key)
+            if n % 50 == 0:
+                await asyncio.sleep(0)
+
+    async def loop_reader():
+        while not done.is_set():
+            check_snapshot(oset.snapshot())
+            await asyncio.sleep(0)
+
+    async def main():
+        readers = [threading.Thread(target=reader) for _ in range(2)]
+        for thread in readers:
+            thread.start()
+        reading = asyncio.create_task(loop_reader())
+        await asyncio.gather(*(asyncio.to_thread(writer, worker) for worker in range(4)), loop_writer())
+        done.set()
+        await reading
+        for thread in readers:
+            thread.join()
+
+    asyncio.run(main())
+
+    assert errors == []
+    check_invariants(oset)
+    # Discards made by one thread can race with evictions, so only the union is exact
+    present = set(oset)
+    assert present.isdisjoint(evicted) and present.isdisjoint(removed)
+    assert len(evicted) == len(set(evicted))
+    assert present | set(evicted) | set(removed) == set(added)
+
+
+def test_a_view_read_while_a_write_starts_is_never_published():
+    oset = ThreadSafeOrderedDequeSet([1, 2, 3])
+    started = []
+
+    class Racing(deque):
+        def __iter__(self):
+            if not started:
+                # As far as readers can tell, a writer in another thread
+                # starts while the view is being copied
+                started.append(True)
+                oset._seq += 1
+            return super().__iter__()
+
+    oset.items = Racing(oset.items)
+    oset.snapshot()
+    assert oset._seq & 1
+    # Nothing may be served from the cache until the write has finished
+    assert oset._published[0] != oset._seq
+    oset._seq += 1
+    assert oset.snapshot() == (1, 2, 3)
+    assert oset._published == (oset._seq, (1, 2, 3))
+
+
+def test_async_view_wakes_on_writes_from_threads_and_the_loop():
+    async def main():
+        oset = ThreadSafeOrderedDequeSet(maxlen=3)
+        view = AsyncDequeSetView(oset)
+        try:
+            version = oset.version
+            waiting = asyncio.create_task(view.wait_for_change(version, timeout=5))
+            await asyncio.sleep(0)
+            await asyncio.to_thread(oset.merge, [1, 2])
+            version, snapshot = await waiting
+            assert snapshot == (1, 2) == view.snapshot()
+
+            waiting = asyncio.create_task(view.wait_for_change(version, timeout=5))
+            await asyncio.sleep(0)
+            oset.add(3)
+            version, snapshot = await waiting
+            assert snapshot == (1, 2, 3)
+
+            # A change made before the wait starts is returned straight away
+            oset.add(4)
+            assert await view.wait_for_change(version, timeout=0) == (oset.version, (2, 3, 4))
+
+            with pytest.raises(asyncio.TimeoutError):
+                await view.wait_for_change(oset.version, timeout=0.01)
+        finally:
+            view.close()
+        assert oset._listeners == []
+
+    asyncio.run(main())
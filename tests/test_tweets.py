@@ -0,0 +1,73 @@
+"""
+fetch_list_timeline paging back to the cursor against a fake list_timeline
+that, like Twitter's, drops retweets after applying `count`.
+"""
+import logging
+from types import SimpleNamespace
+
+from tweets import TIMELINE_DEPTH, fetch_list_timeline
+
+
+class FakeAPI:
+    def __init__(self, ids, dropped=lambda tweet_id: False):
+        self.ids = sorted(ids, reverse=True)
+        self.dropped = dropped
+        self.calls = 0
+        self.last_response = SimpleNamespace(content=b"{}", headers={})
+
+    def list_timeline(self, list_id, owner_id, since_id, max_id, count, tweet_mode):
+        self.calls += 1
+        window = [
+            tweet_id
+            for tweet_id in self.ids
+            if (since_id is None or tweet_id > since_id) and (max_id is None or tweet_id <= max_id)
+        ][:count]
+        return [
+            SimpleNamespace(
+                id=tweet_id,
+                created_at=SimpleNamespace(timestamp=lambda tweet_id=tweet_id: float(tweet_id)),
+                author=SimpleNamespace(screen_name="someone"),
+                full_text=f"tweet {tweet_id}",
+                retweeted_status=None,
+            )
+            for tweet_id in window
+            if not self.dropped(tweet_id)
+        ]
+
+
+def fetched_ids(timeline):
+    return [tweet.id for tweet in timeline]
+
+
+def test_short_pages_do_not_end_the_walk(caplog):
+    api = FakeAPI(range(1, 101), dropped=lambda tweet_id: tweet_id % 3 == 0)
+    with caplog.at_level(logging.WARNING):
+        timeline = fetch_list_timeline(1, 0, api, since_id=10, page_size=20)
+    assert fetched_ids(timeline) == [i for i in range(11, 101) if i % 3]
+    # The last page reaches back to 11 without knowing it is the end, so one empty page follows
+    assert api.calls == 6
+    assert "older ones are lost" not in caplog.text
+
+
+def test_without_a_cursor_only_one_page_is_fetched():
+    api = FakeAPI(range(1, 101))
+    assert fetched_ids(fetch_list_timeline(1, 0, api, page_size=20)) == list(range(81, 101))
+    assert api.calls == 1
+
+
+def test_warns_only_when_the_last_allowed_page_was_full(caplog):
+    pages = TIMELINE_DEPTH // 20
+    # More tweets since the cursor than the walk may fetch
+    api = FakeAPI(range(1, TIMELINE_DEPTH + 100))
+    with caplog.at_level(logging.WARNING):
+        timeline = fetch_list_timeline(1, 0, api, since_id=50, page_size=20)
+    assert len(timeline) == TIMELINE_DEPTH and api.calls == pages
+    assert "older ones are lost" in caplog.text
+
+    # The walk runs out of pages, but the last one was cut short by a dropped retweet
+    caplog.clear()
+    api = FakeAPI(range(1, TIMELINE_DEPTH + 51), dropped=lambda tweet_id: tweet_id == 60)
+    with caplog.at_level(logging.WARNING):
+        timeline = fetch_list_timeline(1, 0, api, since_id=50, page_size=20)
+    assert len(timeline) == TIMELINE_DEPTH - 1 and api.calls == pages
+    assert "older ones are lost" not in caplog.text
@@ -1,14 +1,89 @@
 import tweepy as tp
+import asyncio
+import logging
 import os
+import random
+import sys
+import time
 from dotenv import load_dotenv
 from pprint import pprint
 from collections import defaultdict
-from dequeset import OrderedDequeSet
+from dequeset import TimeOrderedDequeSet
 from datetime import datetime
+from operator import attrgetter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from latency import tracker
 
 load_dotenv()
 env = dict(os.environ)
 
+# tweepy's v1.1 client is blocking, so timeline requests run on a small pool of
+# worker threads instead of the event loop. The pool size caps how many requests
+# can be in flight at once; requests queued behind them are dropped if their
+# caller times out or is cancelled before a worker picks them up.
+MAX_INFLIGHT_FETCHES = 4
+FETCH_TIMEOUT = 10.0
+_fetch_executor = ThreadPoolExecutor(max_workers=MAX_INFLIGHT_FETCHES, thread_name_prefix="tweet-fetch")
+
+# Twitter caps a list at 5000 members
+LIST_MEMBER_LIMIT = 5000
+# lists/members/create_all and destroy_all take at most 100 accounts per call
+LIST_BATCH_SIZE = 100
+# lists/statuses returns at most 200 tweets per page and only reaches about 800 tweets back
+MAX_PAGE_SIZE = 200
+TIMELINE_DEPTH = 800
+
+
+class Tweet:
+    """
+    A tweet as it flows through the bot. Tweets are hashed and compared by id
+    only, so deduplicating them never compares their text, and screen names
+    are interned so every tweet from the same account shares one string.
+    """
+
+    __slots__ = ("timestamp", "screen_name", "id", "text")
+
+    def __init__(self, timestamp: float, screen_name: str, id: int, text: str):
+        self.timestamp = timestamp
+        self.screen_name = sys.intern(screen_name)
+        self.id = id
+        self.text = text
+
+    @classmethod
+    def from_status(cls, status) -> "Tweet":
+        """Build a Tweet from a tweepy Status fetched in extended tweet mode"""
+        return cls(status.created_at.timestamp(), status.author.screen_name.strip().lower(), status.id, status.full_text)
+
+    @property
+    def url(self) -> str:
+        return f"https://twitter.com/{self.screen_name}/status/{self.id}"
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, Tweet):
+            return self.id == other.id
+        return NotImplemented
+
+    def __repr__(self):
+        return f"Tweet({self.timestamp!r}, {self.screen_name!r}, {self.id!r}, {self.text!r})"
+
+    def __reduce__(self):
+        return (self.__class__, (self.timestamp, self.screen_name, self.id, self.text))
+
+    def __sizeof__(self):
+        # The screen name is interned and shared, so only the text is counted
+        return object.__sizeof__(self) + sys.getsizeof(self.text)
+
+
+class TweetTimeline(TimeOrderedDequeSet):
+    """A TimeOrderedDequeSet of Tweets, ordered by when they were posted"""
+
+    timestamp_key = staticmethod(attrgetter("timestamp"))
+
 
 def create_auth():
     access_token = env["ACCESS_TOKEN"]
@@ -18,16 +93,347 @@ def create_auth():
     return tp.OAuth1UserHandler(consumer_key, consumer_secret, access_token, access_token_secret)
 
 
-def create_api() -> tp.API:
+def create_api(wait_on_rate_limit: bool = True) -> tp.API:
     auth = create_auth()
-    return tp.API(auth=auth, wait_on_rate_limit=True)
+    return tp.API(auth=auth, wait_on_rate_limit=wait_on_rate_limit)
+
+
+class PollScheduler:
+    """
+    Decides how long to wait before the next timeline poll.
+
+    The delay is the larger of two intervals:
+    - Budget: the requests left in the rate-limit window, spread evenly over
+      the time until it resets, read from the x-rate-limit-* headers. A poll
+      that takes several requests (more pages, more lists) spends more of it.
+    - Activity: drops to `min_interval` as soon as a poll brings new tweets and
+      grows by `idle_growth` with every empty poll, up to `max_interval`.
+
+    Server errors back off exponentially with jitter. After `failure_threshold`
+    failures in a row the breaker opens and polling stops for `cooldown`
+    seconds; the next poll after that is a trial that closes it on success.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 1.0,
+        max_interval: float = 15.0,
+        idle_growth: float = 1.25,
+        base_backoff: float = 2.0,
+        max_backoff: float = 120.0,
+        failure_threshold: int = 5,
+        cooldown: float = 300.0,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_growth = idle_growth
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        # Quota as of the last response; None until the first one arrives
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.activity_interval = min_interval
+        self.failures = 0
+        self.open_until = 0.0
+        self.interval = min_interval
+        # Requests made by the poll in progress, counted by observe()
+        self.poll_requests = 0
+
+    def observe(self, response) -> None:
+        """Record the quota headers of a timeline response, if it has them"""
+        self.poll_requests += 1
+        headers = getattr(response, "headers", None) or {}
+        try:
+            self.limit = int(headers["x-rate-limit-limit"])
+            self.remaining = int(headers["x-rate-limit-remaining"])
+            self.reset_at = float(headers["x-rate-limit-reset"])
+        except (KeyError, ValueError):
+            pass
+
+    def budget_interval(self, now: float = None, requests: int = 1) -> float:
+        """The interval that spends the remaining requests evenly until the window resets"""
+        now = time.time() if now is None else now
+        if self.remaining is None or self.reset_at is None or self.reset_at <= now:
+            return 0.0
+        return (self.reset_at - now) * requests / max(self.remaining, 1)
+
+    def record_success(self, new_tweets: int) -> float:
+        """Note a completed poll that returned `new_tweets` tweets; returns the next delay"""
+        self.failures = 0
+        self.open_until = 0.0
+        if new_tweets:
+            self.activity_interval = self.min_interval
+        else:
+            self.activity_interval = min(self.activity_interval * self.idle_growth, self.max_interval)
+        budget = self.budget_interval(requests=max(self.poll_requests, 1))
+        self.poll_requests = 0
+        self.interval = max(self.activity_interval, budget, self.min_interval)
+        return self.interval
+
+    def record_failure(self, rate_limited: bool = False) -> float:
+        """Note a failed poll; returns the next delay"""
+        now = time.time()
+        self.poll_requests = 0
+        if rate_limited and self.reset_at and self.reset_at > now:
+            # Out of quota, which is not the server's fault: wait for the window to reset
+            self.remaining = 0
+            self.interval = self.reset_at - now + random.uniform(0, 1)
+            return self.interval
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.open_until = now + self.cooldown
+            self.interval = self.cooldown
+        else:
+            backoff = min(self.base_backoff * 2 ** (self.failures - 1), self.max_backoff)
+            # Full jitter keeps several clients from retrying in lockstep
+            self.interval = max(random.uniform(0, backoff), self.min_interval)
+        return self.interval
+
+    @property
+    def circuit_open(self) -> bool:
+        return time.time() < self.open_until
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "interval": self.interval,
+            "budget_interval": self.budget_interval(now),
+            "activity_interval": self.activity_interval,
+            "limit": self.limit,
+            "remaining": self.remaining,
+            "reset_in": max(self.reset_at - now, 0.0) if self.reset_at else None,
+            "failures": self.failures,
+            "circuit_open": self.circuit_open,
+        }
+
 
+class ListPool:
+    """
+    Spreads tracked accounts over several Twitter lists, so the number of
+    accounts is not capped by one list's member limit. Only the bookkeeping
+    lives here; callers make the matching API calls.
 
-def get_list_timeline(list_id: int, owner_id: int, api: tp.API = None) -> OrderedDequeSet:
+    Example:
+        >>> pool = ListPool([1, 2], capacity=2)
+        >>> pool.place("a"), pool.place("b"), pool.place("c")
+        (1, 2, 1)
+        >>> pool.remove("b")
+        2
+        >>> [(src, dst) for name, src, dst in pool.rebalance()]
+        [(1, 2)]
+    """
+
+    def __init__(self, list_ids: List[int], capacity: int = LIST_MEMBER_LIMIT):
+        self.capacity = capacity
+        self.members: Dict[int, Set[str]] = {list_id: set() for list_id in list_ids}
+        self.placement: Dict[str, int] = {}
+
+    @property
+    def list_ids(self) -> List[int]:
+        return list(self.members)
+
+    def load(self, list_id: int, screen_names: Iterable[str]) -> None:
+        """Record accounts that are already members of `list_id`"""
+        for name in screen_names:
+            self.members[list_id].add(name)
+            self.placement[name] = list_id
+
+    def place(self, screen_name: str) -> int:
+        """Assign an account to the least loaded list and return that list's id"""
+        if screen_name in self.placement:
+            return self.placement[screen_name]
+        list_id = min(self.members, key=lambda list_id: len(self.members[list_id]))
+        if len(self.members[list_id]) >= self.capacity:
+            raise ValueError(f"All {len(self.members)} lists are full")
+        self.load(list_id, [screen_name])
+        return list_id
+
+    def remove(self, screen_name: str) -> Optional[int]:
+        """Forget an account; returns the list it was on, or None if it was not placed"""
+        list_id = self.placement.pop(screen_name, None)
+        if list_id is not None:
+            self.members[list_id].discard(screen_name)
+        return list_id
+
+    def rebalance(self, max_moves: int = None) -> List[Tuple[str, int, int]]:
+        """
+        Move accounts from the fullest lists to the emptiest until no two lists
+        differ by more than one member, or `max_moves` accounts have moved.
+        Returns the moves as (screen_name, from_list, to_list).
+        """
+        moves = []
+        while max_moves is None or len(moves) < max_moves:
+            fullest = max(self.members, key=lambda list_id: len(self.members[list_id]))
+            emptiest = min(self.members, key=lambda list_id: len(self.members[list_id]))
+            if len(self.members[fullest]) - len(self.members[emptiest]) <= 1:
+                return moves
+            name = self.members[fullest].pop()
+            self.load(emptiest, [name])
+            moves.append((name, fullest, emptiest))
+        return moves
+
+    def reconcile(
+        self, actual: Dict[int, Iterable[str]], wanted: Optional[Iterable[str]] = None
+    ) -> Tuple[Dict[int, List[str]], Dict[int, List[str]]]:
+        """
+        Reset the pool to the members the lists actually have, then work out
+        the fewest changes that leave it holding exactly `wanted`: accounts that
+        are not wanted, or are on a second list, come off, and wanted accounts
+        on no list are placed. With `wanted` None, whatever is on the lists is
+        kept apart from the duplicates. Returns (adds, removes) as account
+        names by list id; the pool already reflects them.
+
+        Example:
+            >>> pool = ListPool([1, 2])
+            >>> pool.reconcile({1: ["a", "b"], 2: ["b", "c"]}, wanted=["a", "b", "d"])
+            ({2: ['d']}, {2: ['b', 'c']})
+            >>> sorted(pool.placement.items())
+            [('a', 1), ('b', 1), ('d', 2)]
+        """
+        self.members = {list_id: set() for list_id in self.members}
+        self.placement = {}
+        wanted = set(wanted) if wanted is not None else None
+        removes = defaultdict(list)
+        for list_id, names in actual.items():
+            for name in names:
+                if name not in self.placement and (wanted is None or name in wanted):
+                    self.load(list_id, [name])
+                else:
+                    removes[list_id].append(name)
+
+        adds = defaultdict(list)
+        for name in sorted(wanted - self.placement.keys()) if wanted is not None else ():
+            try:
+                adds[self.place(name)].append(name)
+            except ValueError as e:
+                logging.warning(f"Cannot place {name} or anyone after it: {e}")
+                break
+        return dict(adds), dict(removes)
+
+    def __contains__(self, screen_name: str) -> bool:
+        return screen_name in self.placement
+
+    def __len__(self) -> int:
+        return len(self.placement)
+
+
+def fetch_list_members(api: tp.API, list_id: int, owner_id: int) -> List[str]:
+    """The screen names on a list, 5000 per request"""
+    members = tp.Cursor(api.get_list_members, list_id=list_id, owner_id=owner_id, count=LIST_MEMBER_LIMIT)
+    return [member.screen_name.lower() for member in members.items()]
+
+
+def add_list_members(api: tp.API, list_id: int, owner_id: int, screen_names: Iterable[str]) -> int:
+    """Add accounts to a list in batches of 100; returns how many requests it took"""
+    return _in_batches(api.add_list_members, list_id, owner_id, list(screen_names))
+
+
+def remove_list_members(api: tp.API, list_id: int, owner_id: int, screen_names: Iterable[str]) -> int:
+    """Remove accounts from a list in batches of 100; returns how many requests it took"""
+    return _in_batches(api.remove_list_members, list_id, owner_id, list(screen_names))
+
+
+def _in_batches(method, list_id: int, owner_id: int, screen_names: List[str]) -> int:
+    requests = 0
+    for start in range(0, len(screen_names), LIST_BATCH_SIZE):
+        method(list_id=list_id, owner_id=owner_id, screen_name=screen_names[start : start + LIST_BATCH_SIZE])
+        requests += 1
+    return requests
+
+
+def reconcile_lists(
+    api: tp.API, pool: ListPool, owner_id: int, wanted: Optional[Iterable[str]] = None
+) -> Tuple[Dict[int, List[str]], Dict[int, List[str]]]:
+    """
+    Blocking: read every list in `pool`, then add and remove members in
+    batches so the lists hold exactly `wanted` (see ListPool.reconcile).
+    Returns the (adds, removes) that were applied.
+    """
+    actual = {list_id: fetch_list_members(api, list_id, owner_id) for list_id in pool.list_ids}
+    adds, removes = pool.reconcile(actual, wanted)
+    for list_id, names in removes.items():
+        remove_list_members(api, list_id, owner_id, names)
+    for list_id, names in adds.items():
+        add_list_members(api, list_id, owner_id, names)
+    return adds, removes
+
+
+def fetch_list_timeline(
+    list_id: int,
+    owner_id: int,
+    api: tp.API = None,
+    since_id: int = None,
+    page_size: int = 20,
+    scheduler: PollScheduler = None,
+) -> TweetTimeline:
+    """
+    Blocking fetch of the tweets on a list; use get_list_timeline from async code.
+
+    Without `since_id` this returns the newest `page_size` tweets. With it, only
+    tweets with a larger id come back, paging backwards with max_id until the
+    cursor is reached, so a burst bigger than one page is not cut short. A
+    short page does not mean the cursor was reached: Twitter drops retweets
+    and deleted tweets after applying `count`, so only an empty page, or one
+    reaching back to `since_id`, ends the walk.
+    The quota headers of every page are passed to `scheduler`, if given.
+    """
     if not api:
         api = create_api()
-    tweets = api.list_timeline(list_id=list_id, owner_id=owner_id, count=20, tweet_mode="extended")
-    cleaned_tweets = OrderedDequeSet()
-    for tweet in tweets:
-        cleaned_tweets.add((tweet.created_at.timestamp(), tweet.author.screen_name.strip().lower(), tweet.id, tweet.full_text))
-    return sorted(cleaned_tweets, key=lambda x: x[0])  # [-1] has most recent tweet by time
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    tweets = []
+    max_id = None
+    for _ in range(TIMELINE_DEPTH // page_size if since_id else 1):
+        page = api.list_timeline(
+            list_id=list_id,
+            owner_id=owner_id,
+            since_id=since_id,
+            max_id=max_id,
+            count=page_size,
+            tweet_mode="extended",
+        )
+        if scheduler is not None:
+            scheduler.observe(api.last_response)
+        metrics.FETCH_BYTES.inc(len(api.last_response.content))
+        tweets.extend(page)
+        if not page or not since_id or page[-1].id <= since_id:
+            break
+        max_id = page[-1].id - 1
+    else:
+        # A last page cut short by filtering may well have been the end of the
+        # walk anyway; only a full one means there were more tweets to fetch
+        if since_id and len(page) == page_size:
+            logging.warning(f"List {list_id} has more than {TIMELINE_DEPTH} tweets since {since_id}; older ones are lost")
+    cleaned_tweets = TweetTimeline()
+    # The API returns newest first, so walk it backwards to append in time order
+    for tweet in reversed(tweets):
+        cleaned_tweets.add(Tweet.from_status(tweet))
+    return cleaned_tweets  # [-1] has most recent tweet by time
+
+
+async def get_list_timeline(
+    list_id: int,
+    owner_id: int,
+    api: tp.API = None,
+    since_id: int = None,
+    page_size: int = 20,
+    scheduler: PollScheduler = None,
+    timeout: float = FETCH_TIMEOUT,
+) -> TweetTimeline:
+    """
+    Fetch the tweets on a list without blocking the event loop. Takes the same
+    cursor arguments as fetch_list_timeline.
+
+    Raises asyncio.TimeoutError if the request takes longer than `timeout`
+    seconds. A request that already started cannot be interrupted, so its
+    worker stays busy until the HTTP call returns, but its result is discarded.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        _fetch_executor, fetch_list_timeline, list_id, owner_id, api, since_id, page_size, scheduler
+    )
+    fresh_tweets = await asyncio.wait_for(future, timeout)
+    tracker.fetched(fresh_tweets)
+    return fresh_tweets
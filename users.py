@@ -0,0 +1,135 @@
+"""
+Twitter account lookups shared by the cogs and the SMS webhook.
+
+Checking that a handle exists used to cost one get_user call per handle per
+command. UserLookup answers from a TTL'd LRU cache instead, remembering
+misses as well as hits, and sends whatever is not cached to lookup_users in
+batches of up to 100. Concurrent lookups of the same handle, from the event
+loop or from the webhook thread, share a single request.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import tweepy as tp
+
+from tweets import create_api
+
+# users/lookup accepts at most 100 screen names per call
+LOOKUP_BATCH_SIZE = 100
+
+
+class UserLookup:
+    """
+    Resolves screen names to user ids, or None for accounts that do not exist.
+
+    Found accounts are cached for `ttl` seconds and missing ones for
+    `negative_ttl`, which is shorter so a newly created account is picked up
+    soon. At most `maxsize` names are cached; the least recently used go first.
+    Errors other than "not found" are raised to the caller and never cached.
+    """
+
+    def __init__(self, api: tp.API = None, ttl: float = 3600.0, negative_ttl: float = 300.0, maxsize: int = 10_000):
+        self.api = api
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[str, Tuple[float, Optional[int]]]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+
+    def _fetch(self, screen_names: List[str]) -> Dict[str, int]:
+        if self.api is None:
+            self.api = create_api()
+        with self._lock:
+            self.requests += 1
+        try:
+            users = self.api.lookup_users(screen_name=screen_names)
+        except tp.NotFound:
+            # Raised when none of the names exist
+            return {}
+        return {user.screen_name.lower(): user.id for user in users}
+
+    def _store(self, screen_name: str, user_id: Optional[int]) -> None:
+        ttl = self.ttl if user_id is not None else self.negative_ttl
+        self._cache[screen_name] = (time.monotonic() + ttl, user_id)
+        self._cache.move_to_end(screen_name)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def lookup(self, screen_names: Iterable[str]) -> Dict[str, Optional[int]]:
+        """
+        Return {screen_name: user id or None} for the given handles, keyed by the
+        cleaned (stripped, lowercased) name. Blocks while the API is called, so
+        use alookup from the event loop.
+        """
+        names = list(dict.fromkeys(name.strip().lower() for name in screen_names))
+        results: Dict[str, Optional[int]] = {}
+        waiting: Dict[str, Future] = {}
+        mine: Dict[str, Future] = {}
+        with self._lock:
+            now = time.monotonic()
+            for name in names:
+                entry = self._cache.get(name)
+                if entry is not None and entry[0] > now:
+                    self._cache.move_to_end(name)
+                    results[name] = entry[1]
+                    self.hits += 1
+                elif name in self._inflight:
+                    # Someone else is already asking for this one
+                    waiting[name] = self._inflight[name]
+                else:
+                    mine[name] = self._inflight[name] = Future()
+                    self.misses += 1
+
+        pending = list(mine)
+        try:
+            for start in range(0, len(pending), LOOKUP_BATCH_SIZE):
+                batch = pending[start : start + LOOKUP_BATCH_SIZE]
+                found = self._fetch(batch)
+                with self._lock:
+                    for name in batch:
+                        user_id = found.get(name)
+                        self._store(name, user_id)
+                        del self._inflight[name]
+                        mine.pop(name).set_result(user_id)
+                        results[name] = user_id
+        except BaseException as e:
+            with self._lock:
+                for name, future in mine.items():
+                    del self._inflight[name]
+                    future.set_exception(e)
+            raise
+
+        for name, future in waiting.items():
+            results[name] = future.result()
+        return {name: results[name] for name in names}
+
+    async def alookup(self, screen_names: Iterable[str]) -> Dict[str, Optional[int]]:
+        """lookup without blocking the event loop"""
+        return await asyncio.to_thread(self.lookup, list(screen_names))
+
+    def exists(self, screen_name: str) -> bool:
+        return self.lookup([screen_name])[screen_name.strip().lower()] is not None
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "hits": self.hits, "misses": self.misses, "requests": self.requests}
+
+
+_shared_lookup: Optional[UserLookup] = None
+_shared_lock = threading.Lock()
+
+
+def user_lookup() -> UserLookup:
+    """The UserLookup shared by everything in this process, created on first use"""
+    global _shared_lookup
+    with _shared_lock:
+        if _shared_lookup is None:
+            _shared_lookup = UserLookup()
+        return _shared_lookup
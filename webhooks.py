@@ -1,6 +1,6 @@
 from flask import Flask, request, redirect, Response
 from twilio.twiml.messaging_response import MessagingResponse
-from tweets import create_api
+from users import user_lookup
 from encrypt import encrypt_msg
 import tweepy as tp
 import json
@@ -44,18 +44,18 @@ def sms_reply():
         print(number)
 
         if args[1] != "ALL":
-            api: tp.API = create_api()
+            # Every handle in the text is checked with one cached, batched lookup
+            try:
+                users = user_lookup().lookup(args[1:])
+            except Exception as e:
+                users = {}
             for handle in args[1:]:
-                try:
-                    _ = api.get_user(handle)
-                    if args[0] == 'STOP':
-                        to_remove.append(handle)
-                    elif args[0] == 'START':
-                        to_add.append(handle)
-                except tp.NotFound as e:
-                    continue
-                except Exception as e:
+                if users.get(handle.strip().lower()) is None:
                     continue
+                if args[0] == 'STOP':
+                    to_remove.append(handle)
+                elif args[0] == 'START':
+                    to_add.append(handle)
             if args[0] == 'STOP':
                 resp.message(f'Unsubscribed from: {", ".join(to_remove)}')
                 change_queue.write(f'\n{number} {handle} "r"')